@@ -1,10 +1,23 @@
+import math
+import multiprocessing
 import os
+import struct
 
-msg_delim = "\x00"
-msg_delim_len = len(msg_delim)
+import numpy as np
 
-msg_delim_binary = ''.join(format(ord(c), '08b') for c in msg_delim)
-msg_delim_binary_len = len(msg_delim_binary)
+# Start method for worker processes. The web app runs inside a multithreaded server, and a forked child can deadlock
+# on locks other threads held at the time of the fork, so workers start in a fresh interpreter instead
+worker_context = multiprocessing.get_context("spawn")
+
+# Every payload starts with a fixed size header: magic, version, lsb bits, flags and payload length
+header_magic = b"STEG"
+header_version = 1
+header_struct = struct.Struct(">4sBBBQ")
+header_len = header_struct.size
+
+# Header flag set when the payload was embedded from bytes rather than a string, so decoders hand it back as bytes.
+# Formats keep their own layout flags in the low bits
+header_flag_binary = 0x80
 
 def get_text_from_file(text_file_path: str):
     """
@@ -31,46 +44,234 @@ def delete_file(input_path: str):
         print(f"Unable to delete {input_path}. Error: {e}")
         pass
 
-def process_payload(msg: str):
+class PayloadHeader:
+    version: int
+    lsb_bits: int
+    flags: int
+    length: int
+
+    def __init__(self, version: int, lsb_bits: int, flags: int, length: int):
+        self.version = version
+        self.lsb_bits = lsb_bits
+        self.flags = flags
+        self.length = length
+
+    def to_bytes(self):
+        """
+        Packs the header into the bytes written in front of the payload.
+        """
+        return header_struct.pack(header_magic, self.version, self.lsb_bits, self.flags, self.length)
+
+    @staticmethod
+    def from_bytes(data: bytes):
+        """
+        Unpacks a header from the first bytes extracted from a cover.
+        :param data: At least header_len bytes.
+        :return: PayloadHeader object, or None if the bytes are not a header this version can read.
+        """
+        if len(data) < header_len:
+            return None
+        magic, version, lsb_bits, flags, length = header_struct.unpack(data[:header_len])
+        if magic != header_magic or version != header_version:
+            return None
+        return PayloadHeader(version, lsb_bits, flags, length)
+
+def process_payload(msg, lsb_bits: int, flags=0, encoding='latin-1'):
     """
     preprocesses the message before encoding into the message.
-    :param msg: The message to be encoded.
-    :return: The message with the delimiter appended to the end.
+    :param msg: The message to be encoded, a string or bytes. Bytes set header_flag_binary.
+    :param lsb_bits: Number of bits stored in each cover sample (1-8).
+    :param flags: Bit flags stored in the header.
+    :param encoding: Encoding of string messages, see msg_to_bytes.
+    :return: The header followed by the message bytes.
     """
-    output = msg + msg_delim
-    return output
+    data = msg_to_bytes(msg, encoding)
+    if isinstance(msg, (bytes, bytearray)):
+        flags |= header_flag_binary
+    header = PayloadHeader(header_version, lsb_bits, flags, len(data))
+    return header.to_bytes() + data
 
-def msg_to_bin(msg: str):
+def symbol_count(byte_count: int, lsb_bits: int):
     """
-    Converts a string message into its binary representation.
-    :param msg: The message to be sent.
-    :return: Returns the message as a binary string.
+    Number of cover samples needed to hold the given number of bytes.
     """
-    return ''.join(format(ord(c), '08b') for c in msg)
+    return math.ceil(byte_count * 8 / lsb_bits)
 
-def bin_to_msg(bin_data: list):
+def msg_to_bytes(msg, encoding='latin-1'):
     """
-    Converts the list of binary data into an ascii string.
-    :param bin_data: A list of each bit in the binary data.
-    :return: An ascii string of the message.
+    Converts a message into the raw bytes that get embedded.
+    :param msg: The message to be sent. Bytes are embedded as they are.
+    :param encoding: Encoding of string messages. The default latin-1 gives one byte per character,
+    characters it cannot encode are replaced.
+    :return: The encoded message.
     """
-    message = []
-    bin_data_len = len(bin_data)
-    # Iterate through the binary data list, 8 characters at a time
-    for i in range(0, bin_data_len, 8):
-        # Convert the current byte to an ascii character
-        byte = ''.join(bin_data[i:i + 8])
-        char = chr(int(byte, 2))
-        # If that character
-        if char == msg_delim_binary:
-            break
-        message.append(char)
-    # Convert output list to a string and return it
-    return ''.join(message).rstrip(msg_delim)
+    if isinstance(msg, (bytes, bytearray)):
+        return bytes(msg)
+    return msg.encode(encoding, 'replace')
 
-def delim_check(bin_msg: list):
-    # Get the final few characters of the binary message (as much as required)
-    bin_msg_end = ''.join(bin_msg[-msg_delim_binary_len:])
-    return bin_msg_end == msg_delim_binary
+def bytes_to_symbols(data: bytes, lsb_bits: int):
+    """
+    Splits raw bytes into lsb_bits wide symbols, one for each cover sample.
+    The last symbol is padded with 0s on the right if the bits do not divide evenly.
+    :param data: The bytes to split.
+    :param lsb_bits: Number of bits stored in each cover sample (1-8).
+    :return: A uint8 numpy array of symbols, most significant bits first.
+    """
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    padding = -len(bits) % lsb_bits
+    if padding:
+        bits = np.concatenate((bits, np.zeros(padding, dtype=np.uint8)))
 
+    # Place each group of bits in the low end of a byte and pack them back together
+    symbol_bits = np.zeros((len(bits) // lsb_bits, 8), dtype=np.uint8)
+    symbol_bits[:, 8 - lsb_bits:] = bits.reshape(-1, lsb_bits)
+    return np.packbits(symbol_bits, axis=1).ravel()
 
+def symbols_to_bytes(symbols, lsb_bits: int):
+    """
+    Joins lsb_bits wide symbols back into raw bytes. Trailing bits that do not fill a byte are dropped.
+    :param symbols: A sequence of symbols extracted from the cover.
+    :param lsb_bits: Number of bits stored in each cover sample (1-8).
+    :return: The bytes the symbols make up.
+    """
+    symbols = np.asarray(symbols, dtype=np.uint8).reshape(-1, 1)
+    bits = np.unpackbits(symbols, axis=1)[:, 8 - lsb_bits:].ravel()
+    bits = bits[:len(bits) - len(bits) % 8]
+    return np.packbits(bits).tobytes()
+
+def msg_to_symbols(msg, lsb_bits: int, flags=0, encoding='latin-1'):
+    """
+    Converts a message into the symbols that will be written to the cover, header included.
+    :param msg: The message to be sent, a string or bytes.
+    :param lsb_bits: Number of bits stored in each cover sample (1-8).
+    :param flags: Bit flags stored in the header.
+    :param encoding: Encoding of string messages, see msg_to_bytes.
+    :return: A uint8 numpy array of symbols.
+    """
+    return bytes_to_symbols(process_payload(msg, lsb_bits, flags, encoding), lsb_bits)
+
+def embed_symbols(samples: np.ndarray, symbols: np.ndarray, lsb_bits: int):
+    """
+    Writes the symbols into the least significant bits of the first samples, in place.
+    :param samples: A writable 1D array of cover samples (any integer dtype).
+    :param symbols: The symbols to write, one per sample.
+    :param lsb_bits: Number of bits stored in each cover sample (1-8).
+    """
+    clear_mask = ~samples.dtype.type((1 << lsb_bits) - 1)
+    target = samples[:len(symbols)]
+    target &= clear_mask
+    target |= symbols.astype(samples.dtype)
+
+def extract_symbols(samples: np.ndarray, lsb_bits: int):
+    """
+    Reads the least significant bits of every sample.
+    :param samples: A 1D array of cover samples (any integer dtype).
+    :param lsb_bits: Number of bits stored in each cover sample (1-8).
+    :return: A uint8 numpy array of symbols.
+    """
+    return (samples & ((1 << lsb_bits) - 1)).astype(np.uint8)
+
+class PayloadReader:
+    """
+    Collects the symbols extracted from a cover until the payload described by its header is complete.
+    Decoders feed it symbols in any chunk size and stop reading the cover once it reports done.
+    """
+    lsb_bits: int
+    header: PayloadHeader
+    symbols_needed: int
+    count: int
+    done: bool
+
+    def __init__(self, lsb_bits: int):
+        self.lsb_bits = lsb_bits
+        self.header = None
+        # Only the header is needed before we know how long the payload is
+        self.symbols_needed = symbol_count(header_len, lsb_bits)
+        self.count = 0
+        self.done = False
+        self._chunks = []
+
+    def remaining(self):
+        """
+        Number of symbols still needed. Decoders use this to extract only as much of the cover as required.
+        """
+        if self.done:
+            return 0
+        return self.symbols_needed - self.count
+
+    def feed(self, symbols):
+        """
+        Adds symbols extracted from the cover. Anything past the end of the payload is ignored.
+        :param symbols: A sequence of symbols.
+        :return: True once the payload is complete, or the header shows there is no payload.
+        """
+        symbols = np.asarray(symbols, dtype=np.uint8)
+        while not self.done and len(symbols) > 0:
+            chunk = symbols[:self.remaining()]
+            symbols = symbols[len(chunk):]
+            self._chunks.append(chunk)
+            self.count += len(chunk)
+
+            if self.count < self.symbols_needed:
+                continue
+            if self.header is None:
+                self.header = PayloadHeader.from_bytes(self._read_bytes())
+                if self.header is None or self.header.lsb_bits != self.lsb_bits:
+                    # No valid header for this lsb count, so there is nothing to decode
+                    self.header = None
+                    self.done = True
+                    break
+                self.symbols_needed = symbol_count(header_len + self.header.length, self.lsb_bits)
+            if self.count >= self.symbols_needed:
+                self.done = True
+        return self.done
+
+    def _read_bytes(self):
+        if len(self._chunks) > 1:
+            self._chunks = [np.concatenate(self._chunks)]
+        return symbols_to_bytes(self._chunks[0], self.lsb_bits) if self._chunks else b""
+
+    def payload(self):
+        """
+        :return: The payload bytes, without the header. Empty if no valid header was found.
+        """
+        if self.header is None:
+            return b""
+        return self._read_bytes()[header_len:header_len + self.header.length]
+
+    def message(self):
+        """
+        :return: The payload as a string, or as bytes if it was embedded from bytes. Empty if no valid header was found.
+        """
+        if self.header is not None and self.header.flags & header_flag_binary:
+            return self.payload()
+        return self.payload().decode('latin-1')
+
+def feed_samples(reader: PayloadReader, samples: np.ndarray):
+    """
+    Extracts symbols from the cover samples and feeds them to the reader, never extracting past the end of the payload.
+    :param reader: The PayloadReader to feed.
+    :param samples: 1D array of cover samples that follow the ones already fed.
+    :return: True once the reader is done.
+    """
+    offset = 0
+    while not reader.done and offset < len(samples):
+        part = samples[offset:offset + reader.remaining()]
+        reader.feed(extract_symbols(part, reader.lsb_bits))
+        offset += len(part)
+    return reader.done
+
+def read_all_payloads(chunks, lsb_levels=range(1, 9)):
+    """
+    Reads the payload for every lsb count in a single pass over the cover.
+    :param chunks: Iterable of 1D sample arrays, in the order the encoder writes to them.
+    :param lsb_levels: The lsb counts to try.
+    :return: Dictionary of lsb count to the PayloadReader for it.
+    """
+    readers = {lsb: PayloadReader(lsb) for lsb in lsb_levels}
+    for chunk in chunks:
+        done = [feed_samples(reader, chunk) for reader in readers.values()]
+        # Stop reading the cover once every lsb count has its payload (or has no header)
+        if all(done):
+            break
+    return readers
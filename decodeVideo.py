@@ -1,35 +1,99 @@
 import cv2
-import os
-import shutil
+import numpy as np
+
+from common import PayloadReader, header_flag_binary, feed_samples, extract_symbols
+from encodeVideo import flag_all_channels, payload_plane
+from frame_pipeline import plane_reader
 
 message_delimiter = "\x00"  # End of message delimiter
 
 
-def bin_to_message(binary_data):
+def payload_planes(video_file, all_channels=False):
+    """
+    Yields the values the payload is packed into, a whole frame at a time, as flat arrays.
+    Green only packing reads just the green plane from ffmpeg, into a buffer reused for every frame.
+    If ffmpeg cannot be run, whole frames are decoded with OpenCV instead.
+    """
+    video_capture = cv2.VideoCapture(video_file)
+    if not video_capture.isOpened():
+        raise Exception(f"Failed to open the video file {video_file}")
+
+    if not all_channels:
+        width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        planes = plane_reader(video_file, "g", width, height)
+        try:
+            # ffmpeg is started when the first plane is read
+            first_plane = next(planes, None)
+        except OSError as e:
+            print(f"Unable to read the green plane with ffmpeg, decoding with OpenCV instead: {e}")
+        else:
+            video_capture.release()
+            if first_plane is not None:
+                yield first_plane
+                yield from planes
+            return
+
+    try:
+        while True:
+            ret, frame = video_capture.read()
+            if not ret:
+                break
+            yield payload_plane(frame, all_channels)
+    finally:
+        video_capture.release()
+
+
+def read_payload(video_file, lsb_bits=1, all_channels=False):
     """
-    Converts binary data into a human-readable message.
-    Stops converting once the message delimiter is found.
+    Reads the payload from the frames of the video, packed the way encodeVideo packs it.
+    Frames stop being read once the payload is complete.
+    :param all_channels: Whether to read every channel of each pixel instead of only green.
+    :return: PayloadReader holding the payload, or None if there is no payload packed that way.
     """
-    message = ''
-    for i in range(0, len(binary_data), 8):
-        byte = "".join(binary_data[i:i + 8])
-        char = chr(int(byte, 2))
-        message += char
-        if char == message_delimiter:
+    reader = PayloadReader(lsb_bits)
+    for plane in payload_planes(video_file, all_channels):
+        # Extract the least significant bits of the whole frame at once
+        if feed_samples(reader, plane):
             break
-    return message
+
+    if reader.header is None or bool(reader.header.flags & flag_all_channels) != all_channels:
+        return None
+    return reader
+
+
+def read_terminated(video_file, lsb_bits=1):
+    """
+    Reads a message written by older versions of encodeVideo, which packed it into the green channel
+    with message_delimiter at the end instead of a header in front.
+    Frames stop being read once the delimiter is found.
+    :return: The message bytes, without the delimiter.
+    """
+    delimiter = message_delimiter.encode('utf-8')
+    message = bytearray()
+    leftover_bits = np.zeros(0, dtype=np.uint8)
+    for plane in payload_planes(video_file):
+        # Extract the least significant bits of the whole frame at once, continuing any byte the last frame split
+        symbols = extract_symbols(plane, lsb_bits).reshape(-1, 1)
+        bits = np.concatenate((leftover_bits, np.unpackbits(symbols, axis=1)[:, 8 - lsb_bits:].ravel()))
+        whole_bits = len(bits) - len(bits) % 8
+        data, leftover_bits = np.packbits(bits[:whole_bits]).tobytes(), bits[whole_bits:]
+
+        end = data.find(delimiter)
+        if end >= 0:
+            message += data[:end]
+            break
+        message += data
+    return bytes(message)
 
 
 def decode_video_with_cv2(video_file, lsb_bits=1, input_format="AVI"):
     """
     Decodes a video to extract the hidden text using LSB steganography.
     Handles lossless video formats like AVI (FFV1) or MOV (Apple Animation).
+    The green channel packing is tried first, then the packing into all three channels,
+    then the delimiter terminated messages older versions wrote.
     """
-    temp_dir = "temp_frames_decode"
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-
-    # Open the video capture if the input is a video file (e.g., AVI with FFV1)
     video_capture = cv2.VideoCapture(video_file)
     if not video_capture.isOpened():
         raise Exception(f"Failed to open the video file {video_file}")
@@ -38,53 +102,21 @@ def decode_video_with_cv2(video_file, lsb_bits=1, input_format="AVI"):
     width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
     max_pixel = frame_count * width * height
+    video_capture.release()
 
     print(f"Total Pixel Count = {max_pixel}")
     print(f"Decoding text from {frame_count} frames of video...")
 
-    binary_message = []
-    delimiter_found = False
-
-    # Process each frame one by one to extract hidden text
-    for frame_num in range(frame_count):
-        ret, frame = video_capture.read()
-        if not ret:
-            break
-
-        # Iterate over the pixels in the frame
-        for row in range(height):
-            for col in range(width):
-
-                green = frame[row, col, 1]
-                # Extract the least significant 'bits' from the pixel value using binary operations
-                bits_value = green & (2 ** lsb_bits - 1)
-
-                binary_value = format(bits_value, f'0{lsb_bits}b')
-                binary_message.extend(binary_value)
-
-                # Check if we've encountered the message delimiter
-                if ''.join(binary_message[-len(message_to_bin(message_delimiter)):]) == message_to_bin(message_delimiter):
-                    delimiter_found = True
-                    break
-
-            if delimiter_found:
-                print(f"No more hidden message found, stopping decoding at frame {frame_num}.")
-                break
-
-        if delimiter_found:
+    for all_channels in [False, True]:
+        reader = read_payload(video_file, lsb_bits, all_channels)
+        if reader is not None:
+            decoded_message = reader.payload()
+            # Binary payloads are handed back as they are
+            if not reader.header.flags & header_flag_binary:
+                decoded_message = decoded_message.decode('utf-8', errors='ignore')
             break
-
-    video_capture.release()
-
-    # Convert binary message to readable text
-    binary_message = ''.join(binary_message)
-    decoded_message = ''.join([chr(int(binary_message[i:i + 8], 2)) for i in range(0, len(binary_message), 8)])
-
-    # Return the decoded message up to the delimiter
-    decoded_message = decoded_message.split(message_delimiter)[0]
-
-    # Clean up temporary files if any
-    shutil.rmtree(temp_dir)
+    else:
+        decoded_message = read_terminated(video_file, lsb_bits).decode('utf-8', errors='ignore')
 
     if decoded_message:
         print(f"Message Decoded...")
@@ -95,11 +127,6 @@ def decode_video_with_cv2(video_file, lsb_bits=1, input_format="AVI"):
     return decoded_message
 
 
-def message_to_bin(message: str):
-    """Convert a string to binary using utf-8 encoding."""
-    return ''.join(format(ord(c), '08b') for c in message)
-
-
 # Example usage:
 if __name__ == "__main__":
     video_file = "output_video_with_audio.mov"  # Your video file path here
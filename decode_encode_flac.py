@@ -2,71 +2,155 @@ import math
 
 import soundfile as sf
 
-from common import msg_to_bin, bin_to_msg, process_payload
-from common import delim_check
+from common import msg_to_symbols, PayloadReader
+from common import embed_symbols, feed_samples, read_all_payloads
 from common import get_text_from_file
 
-def flac_encode(input_path, output_path, message, lsb_bits):
-    # Read the FLAC file
-    data, samplerate = sf.read(input_path, dtype='int16')
-
-    message = process_payload(message)
-    binary_message = msg_to_bin(message)
-    binary_message_len = len(binary_message)
-    payload_idx = 0
+# Number of frames decoded and encoded at a time when streaming a FLAC file
+flac_block_frames = 1 << 16
+
+# Bits per sample of each FLAC subtype. Samples are read into int32 buffers, high bits first
+flac_subtype_bits = {'PCM_S8': 8, 'PCM_16': 16, 'PCM_24': 24}
+
+# FLAC compression level from 0 to 1 used when writing, None keeps libsndfile's default
+# soundfile only takes compression_level from 0.13 on, so it is left out of the call when None
+flac_compression_level = None
+
+def flac_write_options(compression_level=flac_compression_level):
+    """
+    Keyword arguments for writing a FLAC file with soundfile. compression_level is only passed when it is set.
+    """
+    return {} if compression_level is None else {'compression_level': compression_level}
+
+def flac_sample_shift(subtype):
+    """
+    Number of bits the samples of a subtype are shifted up by when read as int32.
+    """
+    if subtype not in flac_subtype_bits:
+        raise ValueError(f"Unsupported FLAC subtype: {subtype}")
+    return 32 - flac_subtype_bits[subtype]
+
+def flac_read(input_path):
+    """
+    Reads a whole FLAC file at its native bit depth.
+    :return: int32 sample array holding the true sample values, the sample rate and the subtype.
+    """
+    with sf.SoundFile(input_path) as cover:
+        data = cover.read(dtype='int32')
+        data >>= flac_sample_shift(cover.subtype)
+        return data, cover.samplerate, cover.subtype
+
+def flac_write(output_path, data, samplerate, subtype, compression_level=flac_compression_level):
+    """
+    Writes samples read by flac_read, keeping the subtype of the cover.
+    """
+    sf.write(output_path, data << flac_sample_shift(subtype), samplerate, subtype=subtype, format='FLAC',
+             **flac_write_options(compression_level))
+
+def flac_embed(data, message, lsb_bits):
+    """
+    Embeds the message into a copy of already decoded audio samples.
+    :param data: Sample array as returned by flac_read. It is not modified.
+    :return: The encoded samples, in the same shape as data.
+    """
+    symbols = msg_to_symbols(message, lsb_bits)
 
     # Flatten audio data to a 1D array
     flat_data = data.flatten()
 
-    # Amount of data needed to hide the stuff you want to hide
-    data_needed = math.ceil(len(binary_message) / lsb_bits)
-    if data_needed > len(flat_data):
+    # Each sample holds one symbol of the message
+    if len(symbols) > len(flat_data):
         raise ValueError("Cover file does not have enough data.")
 
-    # Modify the least significant bits in the audio data
-    for i in range(len(flat_data)):
-        if payload_idx >= binary_message_len:
-            break
-        # Extract the current 'lsb_bits' from the message
-        bits_to_encode = binary_message[payload_idx: payload_idx + lsb_bits]
-        bits_to_encode_int = int(bits_to_encode, 2)
-
-        # Clear the LSBs of the sample and then embed the new bits using binary OR
-        flat_data[i] = (flat_data[i] & ~(2**lsb_bits - 1)) | bits_to_encode_int
-
-        # Update the number of bits encoded
-        payload_idx += lsb_bits
+    # Clear the LSBs of the samples and then embed the message symbols
+    embed_symbols(flat_data, symbols, lsb_bits)
 
     # Reshape the data back to its original shape
-    reshaped_data = flat_data.reshape(data.shape)
-
-    # Write the modified data to a new FLAC file
-    sf.write(output_path, reshaped_data, samplerate)
+    return flat_data.reshape(data.shape)
+
+def flac_encode(input_path, output_path, message, lsb_bits, block_frames=flac_block_frames,
+                compression_level=flac_compression_level):
+    """
+    Embeds the message into the FLAC file, decoding and encoding block_frames frames at a time.
+    The true least significant bits of each sample are used, and the output keeps the cover's subtype.
+    Blocks after the end of the message are copied through unchanged.
+    """
+    symbols = msg_to_symbols(message, lsb_bits)
+
+    with sf.SoundFile(input_path) as cover:
+        # Each sample holds one symbol of the message
+        if len(symbols) > cover.frames * cover.channels:
+            raise ValueError("Cover file does not have enough data.")
+
+        shift = flac_sample_shift(cover.subtype)
+        with sf.SoundFile(output_path, 'w', cover.samplerate, cover.channels, cover.subtype, format='FLAC',
+                          **flac_write_options(compression_level)) as output:
+            payload_index = 0
+            for block in cover.blocks(block_frames, dtype='int32'):
+                if payload_index < len(symbols):
+                    # Embed the symbols that belong to this block's samples, shifted down to their true values
+                    flat_block = block.reshape(-1)
+                    flat_block >>= shift
+                    block_symbols = symbols[payload_index:payload_index + len(flat_block)]
+                    embed_symbols(flat_block, block_symbols, lsb_bits)
+                    flat_block <<= shift
+                    payload_index += len(block_symbols)
+                output.write(block)
     return True
 
-def flac_decode(input_path, lsb_bits):
-    # Read the FLAC file
-    data, samplerate = sf.read(input_path, dtype='int16')
-
-    # Flatten audio data to a 1D array
-    flat_data = data.flatten()
-
-    binary_message = []
-
-    # Extract the least significant bits from the audio data
-    for sample in flat_data:
-        # Extract the 'lsb_bits' from the sample
-        bits_value = sample & (2 ** lsb_bits - 1)
-
-        binary_value = format(bits_value, f'0{lsb_bits}b')
-        binary_message.extend(binary_value)
-
-        if delim_check(binary_message):
-            break
-
-    final_message = bin_to_msg(binary_message)
+def flac_encode_batch(input_path, output_paths: dict, message, compression_level=flac_compression_level):
+    """
+    Embeds the message once for every lsb count, reading the cover only once.
+    :param output_paths: Dictionary of lsb count to the path to write that encoding to.
+    :return: Dictionary of lsb count to True, or to the exception raised for that lsb count.
+    """
+    data, samplerate, subtype = flac_read(input_path)
+
+    outputs = {}
+    for lsb_bits, output_path in output_paths.items():
+        try:
+            flac_write(output_path, flac_embed(data, message, lsb_bits), samplerate, subtype, compression_level)
+            outputs[lsb_bits] = True
+        except ValueError as e:
+            outputs[lsb_bits] = e
+    return outputs
+
+def flac_blocks(cover, block_frames=flac_block_frames):
+    """
+    Yields the true sample values of an open FLAC file a block of frames at a time, as flat int32 arrays.
+    """
+    shift = flac_sample_shift(cover.subtype)
+    for block in cover.blocks(block_frames, dtype='int32'):
+        yield block.reshape(-1) >> shift
+
+def flac_decode(input_path, lsb_bits, block_frames=flac_block_frames):
+    reader = PayloadReader(lsb_bits)
+
+    with sf.SoundFile(input_path) as cover:
+        shift = flac_sample_shift(cover.subtype)
+
+        # Extract the least significant bits from the audio data, reading the header first
+        # and then only as many frames as the payload needs
+        while not reader.done:
+            frames_needed = math.ceil(reader.remaining() / cover.channels)
+            block = cover.read(min(block_frames, frames_needed), dtype='int32')
+            if len(block) == 0:
+                break
+            feed_samples(reader, block.reshape(-1) >> shift)
+
+    final_message = reader.message()
     return final_message
 
+def flac_decode_all(input_path, block_frames=flac_block_frames):
+    """
+    Extracts the hidden message for every lsb count (1-8) from a single pass over the FLAC file,
+    stopping once every lsb count has its payload.
+    :return: Dictionary of lsb count to decoded message.
+    """
+    with sf.SoundFile(input_path) as cover:
+        readers = read_all_payloads(flac_blocks(cover, block_frames))
+    return {lsb: reader.message() for lsb, reader in readers.items()}
+
 
 if __name__ == "__main__":
     # Example usage
@@ -1,28 +1,86 @@
-import cv2
 import math
+import os
 import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+
+import cv2
 
-from common import msg_to_bin, bin_to_msg, process_payload
-from common import delim_check
-from common import get_text_from_file, delete_file
+from common import msg_to_symbols, PayloadReader, read_all_payloads, embed_symbols, feed_samples
+from common import get_text_from_file, worker_context
+from frame_pipeline import pipeline_frames, capture_reader, frame_reader, plane_reader
+
+# Number of worker processes mkv_encode_parallel splits the video between
+segment_workers = os.cpu_count() or 1
+
+def ffv1_writer(input_path, output_path, width, height, fps):
+    """
+    Starts an ffmpeg process that encodes raw BGR frames written to its stdin into a lossless FFV1 video,
+    copying the audio track of the input video into the same file.
+    :param input_path: Video to copy the audio from, or None to write the video without audio.
+    :return: The ffmpeg process. Write each frame to its stdin, then finish with close_writer.
+    """
+    command = ["ffmpeg", "-y", "-loglevel", "error",
+               # Raw frames from stdin
+               "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-"]
+    if input_path is not None:
+        # Audio from the original video, if it has any
+        command += ["-i", input_path, "-map", "0:v", "-map", "1:a?", "-c:a", "copy"]
+    # Every frame is a keyframe, so the output can later be cut at any frame without re-encoding
+    command += ["-c:v", "ffv1", "-pix_fmt", "bgr0", "-g", "1", output_path]
+    # ffmpeg's messages go to a file, as a pipe nobody reads until the end could fill up and stall the encode
+    error_log = tempfile.TemporaryFile()
+    writer = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=error_log)
+    writer.error_log = error_log
+    return writer
+
+def close_writer(writer, check=True):
+    """
+    Closes the stdin of an ffv1_writer process and waits for it to finish writing the video.
+    :param check: Raise RuntimeError if ffmpeg failed. Pass False while another exception is already being raised,
+    so it is not replaced.
+    """
+    try:
+        writer.stdin.close()
+    except BrokenPipeError:
+        # ffmpeg already exited, its return code says why
+        pass
+    writer.wait()
+    writer.error_log.seek(0)
+    errors = writer.error_log.read()
+    writer.error_log.close()
+    if check and writer.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to write the video: {errors.decode(errors='replace')}")
+
+def blue_plane(frame):
+    """
+    View of the blue channel of a BGR frame as a flat array, in the order the encoder writes to it.
+    Writing to the view writes to the frame.
+    """
+    return frame.reshape(-1, 3)[:, 0]
+
+def embed_frame(frame, symbols, payload_index, lsb_bits):
+    """
+    Embeds as many symbols as fit into the blue channel of the frame, in place.
+    :param symbols: Array of all the symbols of the payload.
+    :param payload_index: Index of the first symbol to embed in this frame.
+    :return: The index of the next symbol to embed.
+    """
+    # Clear the LSBs of the blue channel and insert the symbols that belong to this frame
+    frame_symbols = symbols[payload_index:payload_index + frame.shape[0] * frame.shape[1]]
+    embed_symbols(blue_plane(frame), frame_symbols, lsb_bits)
+    return payload_index + len(frame_symbols)
 
 def mkv_encode(input_path, output_path, message, lsb_bits=1):
     print(f"\nEncoding to {output_path}")
-    # Extract audio file from original video file using ffmpeg
-    # We'll save the audio as a temp file which we'll delete after all is said and done
-    temp_audio_path = "input/temp.aac"
-    command = f"ffmpeg -y -i {input_path} -vn -acodec copy {temp_audio_path}"
-    subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    soundless_video_path = output_path.replace(".mkv", "_temp.mkv")
 
     # Open video file
     cap = cv2.VideoCapture(input_path)
 
-    message = process_payload(message)
     print(f"message {message[:100]}")
-    binary_message = msg_to_bin(message)
-    binary_message_len = len(binary_message)
+    symbols = msg_to_symbols(message, lsb_bits)
+    symbols_len = len(symbols)
     payload_index = 0
 
     # get video data
@@ -32,115 +90,324 @@ def mkv_encode(input_path, output_path, message, lsb_bits=1):
     frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     max_pixel = frame_count * width * height
 
-    # Create a video writer to save the modified video using FFV1 (lossless)
-    fourcc = cv2.VideoWriter_fourcc(*'FFV1')  # Use lossless FFV1 codec
-    out = cv2.VideoWriter(soundless_video_path, fourcc, fps, (width, height))
-
-    bytes_needed = math.ceil(len(binary_message) / lsb_bits)
-    if bytes_needed > frame_count * width * height:
+    if symbols_len > max_pixel:
+        cap.release()
         raise ValueError("Cover file does not have enough data.")
 
-    pixel_count = 1
-    pixel_edited_count = 0
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
+    # Frames are piped straight into ffmpeg, which encodes them with FFV1 (lossless) and copies the audio over
+    out = ffv1_writer(input_path, output_path, width, height, fps)
+
+    def embed(frame):
+        nonlocal payload_index
+        # Frames after the end of the payload are written as they are
+        if payload_index < symbols_len:
+            payload_index = embed_frame(frame, symbols, payload_index, lsb_bits)
+        return frame
+
+    # Decoding, embedding and writing to the output file overlap on separate threads
+    # ffmpeg's error is only reported if nothing else failed first, or if ffmpeg stopped reading the frames
+    report_errors = False
+    try:
+        pipeline_frames(capture_reader(cap), embed, lambda frame: out.stdin.write(frame.data), (height, width, 3))
+        report_errors = True
+    except BrokenPipeError:
+        report_errors = True
+        raise
+    finally:
+        cap.release()
+        close_writer(out, check=report_errors)
+
+    print(f"Pixels Edited: {payload_index}/{max_pixel}")
+    print("MKV Encoding End\b")
+    return True
 
-        for i in range(height):
-            for j in range(width):
-                pixel_count += 1
-                # Leave the loop if we have oth
-                if payload_index < binary_message_len:
-                    # Get the bits that we will be appending to the current binary value
-                    bits_to_encode = binary_message[payload_index: payload_index + lsb_bits]
-                    # If there are not enough characters in the binary, we just add some zeroes to the left
-                    if len(bits_to_encode) < lsb_bits:
-                        bits_to_encode = bits_to_encode.ljust(lsb_bits, '0')
-
-                    # Get pixel val of binary
-                    blue = frame[i, j, 0]
-
-                    # get the binary data of the original pixel based on the size of the data we are encoding
-                    # if we are replacing all 8 bits, then we just need to set the value to the provided bits
-                    if lsb_bits == 8:
-                        blue = int(bits_to_encode, 2)
-                    else:
-                        blue_binary = format(blue, '08b')
-                        blue_binary = blue_binary[:-lsb_bits] + bits_to_encode
-                        blue = int(blue_binary, 2)
-
-                    frame[i, j, 0] = blue
-
-                    payload_index += lsb_bits
-                    pixel_edited_count += 1
-
-        # write to output file
-        out.write(frame)
+def encode_segment(input_path, segment_path, start_time, frame_count, symbols, lsb_bits, width, height, fps):
+    """
+    Embeds symbols into frame_count frames of the video starting at the frame shown at start_time, and writes them
+    to their own FFV1 video without audio.
+    :param start_time: Timestamp in microseconds from frame_timestamps, or None to start at the first frame.
+    :param symbols: The symbols that belong to this segment, starting at its first frame.
+    :return: True if the segment has any frames and was written.
+    """
+    out = None
+    payload_index = 0
+    # ffmpeg's error is only reported if nothing else failed first, or if ffmpeg stopped reading the frames
+    report_errors = False
+    try:
+        for frame in frame_reader(input_path, width, height, start_time, frame_count):
+            if out is None:
+                out = ffv1_writer(None, segment_path, width, height, fps)
+            if payload_index < len(symbols):
+                payload_index = embed_frame(frame, symbols, payload_index, lsb_bits)
+            out.stdin.write(frame.data)
+        report_errors = True
+    except BrokenPipeError:
+        report_errors = True
+        raise
+    finally:
+        if out is not None:
+            close_writer(out, check=report_errors)
+    return out is not None
+
+def concat_segments(segment_paths, temp_dir, input_path, output_path, tail_start=None):
+    """
+    Joins FFV1 segments into one video without re-encoding them, copying the audio of the input video alongside.
+    :param temp_dir: Directory to write the concat demuxer's list of segments to.
+    :param tail_start: If given, the video stream of the input from this timestamp in microseconds on is copied
+    after the segments. Only exact for intra-only codecs such as FFV1.
+    """
+    if not segment_paths:
+        raise ValueError("No video segments to join, the cover has no readable video frames.")
+
+    def entry(path):
+        # Single quotes are escaped the way the concat demuxer expects
+        return "file '" + os.path.abspath(path).replace("'", "'\\''") + "'\n"
+
+    list_path = os.path.join(temp_dir, "segments.txt")
+    with open(list_path, 'w') as f:
+        for segment_path in segment_paths:
+            f.write(entry(segment_path))
+        if tail_start is not None:
+            f.write(entry(input_path))
+            f.write(f"inpoint {tail_start}us\n")
+
+    command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+               "-i", input_path, "-map", "0:v", "-map", "1:a?", "-c", "copy", output_path]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to join the video: {result.stderr.decode(errors='replace')}")
+
+def is_ffv1_bgr0(cap):
+    """
+    Whether an opened video is FFV1 with the bgr0 pixel format the encoders write, so its frames can be
+    stream copied next to newly encoded ones.
+    """
+    fourcc = (int(cap.get(cv2.CAP_PROP_FOURCC)) & 0xFFFFFFFF).to_bytes(4, 'little')
+    pixel_format = (int(cap.get(cv2.CAP_PROP_CODEC_PIXEL_FORMAT)) & 0xFFFFFFFF).to_bytes(4, 'little')
+    return fourcc.lower() == b"ffv1" and pixel_format == b"BGR\x00"
+
+def frame_timestamps(input_path):
+    """
+    Reads the timestamp of every frame of a video from its packets, without decoding them.
+    The timestamps are relative to the start of the file, as ffmpeg's -ss expects them.
+    :return: Timestamps in microseconds, in the order the frames are shown.
+    """
+    command = ["ffmpeg", "-loglevel", "error", "-i", input_path, "-map", "0:v:0", "-c", "copy", "-f", "framecrc", "-"]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    time_base = None
+    timestamps = []
+    for line in result.stdout.splitlines():
+        if line.startswith("#tb 0:"):
+            time_base = Fraction(line.split(":")[1].strip())
+        if line.startswith("#"):
+            continue
+        # stream, dts, pts, ... Packets are stored in decoding order, so sort them into the order they are shown
+        pts = int(line.split(",")[2])
+        timestamps.append(math.floor(pts * time_base * 1000000))
+    return sorted(timestamps)
+
+def keyframe_timestamp(input_path, frame_index):
+    """
+    Finds the timestamp of a frame, reading the packets of the video up to it without decoding them.
+    The video can only be cut there without re-encoding if every frame up to it is a keyframe,
+    as ffmpeg may otherwise start the cut at an earlier keyframe.
+    :return: Timestamp of the frame in microseconds, or None if it does not exist or a frame up to it is not a keyframe.
+    This is the frame's own timestamp, as the concat demuxer's inpoint expects, not one relative to the start of the file.
+    """
+    # copyts keeps the packet timestamps as they are, instead of shifting them to start at 0
+    command = ["ffmpeg", "-loglevel", "error", "-copyts", "-i", input_path, "-map", "0:v:0", "-c", "copy",
+               "-f", "framecrc", "-"]
+    scanner = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        time_base = None
+        index = 0
+        for line in scanner.stdout:
+            if line.startswith("#tb 0:"):
+                time_base = Fraction(line.split(":")[1].strip())
+            if line.startswith("#"):
+                continue
+
+            # stream, dts, pts, duration, size, crc and the packet flags if they are anything but keyframe
+            fields = [field.strip() for field in line.split(",")]
+            flags = next((int(field[2:], 16) for field in fields[6:] if field.startswith("F=")), 1)
+            if not flags & 1:
+                return None
+            if index == frame_index:
+                return math.floor(int(fields[2]) * time_base * 1000000)
+            index += 1
+    finally:
+        scanner.kill()
+        scanner.wait()
+    return None
+
+def mkv_encode_surgical(input_path, output_path, message, lsb_bits=1):
+    """
+    Embeds the message like mkv_encode, but only decodes and re-encodes the frames that carry the payload.
+    The rest of the video is stream copied from the cover, so the time taken depends on the payload size
+    rather than the length of the video.
+    This needs the cover to be FFV1 in bgr0 with every frame a keyframe, as the encoders write it.
+    Any other cover falls back to mkv_encode.
+    """
+    cap = cv2.VideoCapture(input_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
+    symbols = msg_to_symbols(message, lsb_bits)
+    stream_copy = is_ffv1_bgr0(cap)
     cap.release()
-    out.release()
-
-    # Combine audio with video
-    command = f"ffmpeg -y -i {soundless_video_path} -i {temp_audio_path} -c:v copy -c:a aac {output_path}"
-    #command = f"ffmpeg -y -i {soundless_video_path} -c:v copy -c:a aac {output_path}"
-    #subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    subprocess.run(command, shell=True)
-    # delete the temp files
-    delete_file(temp_audio_path)
-    delete_file(soundless_video_path)
-
-    print(f"Pixels Edited: {pixel_edited_count}/{pixel_count}")
-    print("MKV Encoding End\b")
+    if len(symbols) > frame_count * width * height:
+        raise ValueError("Cover file does not have enough data.")
+    payload_frames = math.ceil(len(symbols) / (width * height))
+
+    tail_start = keyframe_timestamp(input_path, payload_frames) if stream_copy else None
+    if tail_start is None:
+        # Either the cover cannot be cut without re-encoding it or every frame carries payload
+        return mkv_encode(input_path, output_path, message, lsb_bits)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        segment_path = os.path.join(temp_dir, "segment0.mkv")
+        encode_segment(input_path, segment_path, None, payload_frames, symbols, lsb_bits, width, height, fps)
+        concat_segments([segment_path], temp_dir, input_path, output_path, tail_start)
     return True
 
-def mkv_decode(input_path, lsb_bits=1):
-    cap = cv2.VideoCapture(input_path)
+def mkv_encode_parallel(input_path, output_path, message, lsb_bits=1, workers=None):
+    """
+    Embeds the message like mkv_encode, with the video split into segments that are embedded and encoded
+    by separate worker processes. Each worker seeks straight to its segment, so no frame is decoded twice.
+    The payload offset of every frame follows from the frame size, so each segment is given its own slice
+    of the symbols up front. Covers that mkv_encode_surgical can cut have only their payload frames split
+    between the workers and the rest stream copied, other covers have all their frames split between the workers.
+    The segments are then joined without re-encoding.
+    :param workers: Number of worker processes, defaults to segment_workers.
+    """
+    workers = workers or segment_workers
 
+    cap = cv2.VideoCapture(input_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    stream_copy = is_ffv1_bgr0(cap)
+    cap.release()
 
-    binary_message = []
-    done = False
+    symbols = msg_to_symbols(message, lsb_bits)
+    frame_pixels = width * height
+    if len(symbols) > frame_count * frame_pixels:
+        raise ValueError("Cover file does not have enough data.")
 
-    curr_pixel = 0
-    max_pixel = frame_count * width * height
-    while cap.isOpened() and not done:
-        ret, frame = cap.read()
+    # Frames after the payload are stream copied if the cover allows it, otherwise they are encoded as well
+    payload_frames = math.ceil(len(symbols) / frame_pixels)
+    tail_start = keyframe_timestamp(input_path, payload_frames) if stream_copy else None
+    timestamps = frame_timestamps(input_path)
+    encoded_frames = payload_frames if tail_start is not None else len(timestamps)
+    if encoded_frames == 0:
+        raise ValueError("Cover file has no readable video frames.")
+
+    # Split the frames to encode into one segment per worker
+    segment_count = min(workers, encoded_frames)
+    bounds = [encoded_frames * i // segment_count for i in range(segment_count + 1)]
+    segments = [(timestamps[start] if start else None, end - start, symbols[start * frame_pixels:end * frame_pixels])
+                for start, end in zip(bounds, bounds[1:]) if end > start]
+    if tail_start is None:
+        # The last segment reads to the end, in case the cover has frames the packet scan did not count
+        start_time, _, segment_symbols = segments[-1]
+        segments[-1] = (start_time, None, segment_symbols)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        segment_paths = [os.path.join(temp_dir, f"segment{i}.mkv") for i in range(len(segments))]
+        with ProcessPoolExecutor(max_workers=len(segments), mp_context=worker_context) as pool:
+            futures = [pool.submit(encode_segment, input_path, segment_path, start_time, segment_frames,
+                                   segment_symbols, lsb_bits, width, height, fps)
+                       for segment_path, (start_time, segment_frames, segment_symbols) in zip(segment_paths, segments)]
+            written = [future.result() for future in futures]
+        concat_segments([path for path, wrote in zip(segment_paths, written) if wrote], temp_dir, input_path,
+                        output_path, tail_start)
+    return True
 
-        if not ret:
-            break
+def mkv_encode_batch(input_path, output_paths: dict, message):
+    """
+    Embeds the message once for every lsb count, decoding each frame of the cover only once.
+    Every decoded frame is embedded into and piped to one ffmpeg writer per lsb count.
+    :param output_paths: Dictionary of lsb count to the path to write that encoding to.
+    :return: Dictionary of lsb count to True, or to the exception raised for that lsb count.
+    """
+    cap = cv2.VideoCapture(input_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
-        height, width, _ = frame.shape
-        for i in range(height):
-            if done:
+    outputs = {}
+    encoders = {}
+    for lsb_bits, output_path in output_paths.items():
+        symbols = msg_to_symbols(message, lsb_bits)
+        if len(symbols) > frame_count * width * height:
+            outputs[lsb_bits] = ValueError("Cover file does not have enough data.")
+            continue
+        out = ffv1_writer(input_path, output_path, width, height, fps)
+        # writer, symbols and next symbol index for each lsb count
+        encoders[lsb_bits] = [out, symbols, 0]
+
+    try:
+        while cap.isOpened() and encoders:
+            ret, frame = cap.read()
+            if not ret:
                 break
 
-            for j in range(width):
-                # Get the blue channel value
-                blue = frame[i, j, 0]
-                # Extract the least significant 'bits' from the pixel value using binary operations
-                bits_value = blue & (2 ** lsb_bits - 1)
-
-                binary_value = format(bits_value, f'0{lsb_bits}b')
-                binary_message.extend(binary_value)
+            for lsb_bits, encoder in encoders.items():
+                out, symbols, payload_index = encoder
+                if payload_index < len(symbols):
+                    encoded_frame = frame.copy()
+                    encoder[2] = embed_frame(encoded_frame, symbols, payload_index, lsb_bits)
+                    out.stdin.write(encoded_frame.tobytes())
+                else:
+                    out.stdin.write(frame.tobytes())
+    finally:
+        cap.release()
+        for lsb_bits, (out, _, _) in encoders.items():
+            try:
+                close_writer(out)
+                outputs[lsb_bits] = True
+            except RuntimeError as e:
+                outputs[lsb_bits] = e
+    return outputs
 
-                # Check if we've encountered the message delimiter
-                if delim_check(binary_message):
-                    done = True
-                    break
+def mkv_decode(input_path, lsb_bits=1):
+    reader = PayloadReader(lsb_bits)
 
-                curr_pixel += 1
-                if curr_pixel % 1000000 == 0:
-                    print(f"{curr_pixel} of {max_pixel}")
+    # Extract the blue channel of a whole frame at a time, and stop reading frames once the header says
+    # the payload is complete
+    for plane in blue_planes(input_path):
+        if feed_samples(reader, plane):
+            break
 
-    cap.release()
     # Convert the binary message to readable text
-    final_message = bin_to_msg(binary_message)
+    final_message = reader.message()
 
     return final_message
 
+def blue_planes(input_path):
+    """
+    Yields the blue channel of each frame of the video as a flat array, in the order the encoder writes to it.
+    Only the blue plane is read from ffmpeg, into a buffer that is reused for every frame.
+    """
+    cap = cv2.VideoCapture(input_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    yield from plane_reader(input_path, "b", width, height)
+
+def mkv_decode_all(input_path):
+    """
+    Extracts the hidden message for every lsb count (1-8) from a single decode of the video.
+    Frames stop being read once every lsb count has its payload.
+    :return: Dictionary of lsb count to decoded message.
+    """
+    readers = read_all_payloads(blue_planes(input_path))
+    return {lsb: reader.message() for lsb, reader in readers.items()}
+
 
 if __name__ == "__main__":
     input_path = "input/comeon.mkv"
@@ -1,89 +1,343 @@
 import math
+import os
+import shutil
+import struct
+import zlib
+
+import numpy as np
 from PIL import Image
 
-from common import msg_to_bin, bin_to_msg, process_payload
-from common import delim_check
+from common import msg_to_symbols, PayloadReader
+from common import embed_symbols, extract_symbols
 
-def png_encode(image_path: str, message: str, lsb_bits=1):
-    """Encodes a message into the PNG image."""
-    image = Image.open(image_path)
-    # image must be in RGB mode  may not be in RGB
-    image = image.convert('RGBA')
+png_signature = b"\x89PNG\r\n\x1a\n"
+# Default upper bound on the image data held in memory by png_encode_stream
+stream_memory_budget = 64 * 1024 * 1024
 
-    # Preprocess payload before insertion
-    message = process_payload(message)
-    binary_message = msg_to_bin(message)
-    binary_message_len = len(binary_message)
-    payload_index = 0
+def embed_pixels(rgba: np.ndarray, symbols: np.ndarray, lsb_bits: int):
+    """
+    Writes the symbols into the RGB channels of the pixels, in place.
+    Only the pixels the payload occupies are touched.
+    :param rgba: Writable (pixel, channel) array of the RGBA image.
+    :param symbols: The symbols to write, one per RGB channel value.
+    :param lsb_bits: Number of bits stored in each channel (1-8).
+    """
+    pixel_count = math.ceil(len(symbols) / 3)
+    # View of the RGB channels of the pixels that will hold the payload
+    rgb = rgba[:pixel_count, :3]
+    channels = rgb.reshape(-1)
+    embed_symbols(channels, symbols, lsb_bits)
+    rgb[...] = channels.reshape(rgb.shape)
 
+def read_pixels(rgba: np.ndarray, lsb_bits: int):
+    """
+    Extracts the payload from the RGB channels of the pixels, reading only as far as the payload goes.
+    :param rgba: (pixel, channel) array of the RGBA image.
+    :param lsb_bits: Number of bits stored in each channel (1-8).
+    :return: The PayloadReader holding the payload.
+    """
+    reader = PayloadReader(lsb_bits)
+    channel_count = len(rgba) * 3
+    while not reader.done and reader.count < channel_count:
+        start = reader.count
+        stop = min(start + reader.remaining(), channel_count)
+        # Take the pixels covering channel values [start, stop) and drop the alpha channel
+        first_pixel = start // 3
+        rgb = rgba[first_pixel:math.ceil(stop / 3), :3].reshape(-1)
+        channels = rgb[start - first_pixel * 3:stop - first_pixel * 3]
+        reader.feed(extract_symbols(channels, lsb_bits))
+    return reader
+
+def png_embed(pixels: np.ndarray, message: str, lsb_bits=1):
+    """
+    Encodes a message into a copy of an already decoded image.
+    :param pixels: (height, width, 4) array of the RGBA image. It is not modified.
+    :return: The encoded image.
+    """
     # Limits bits to update to only 8
     if lsb_bits > 8:
         lsb_bits = 8
 
-    pixels = image.getdata()
+    # Preprocess payload (header + message) before insertion
+    symbols = msg_to_symbols(message, lsb_bits)
+
+    # One row per pixel, one column per channel
+    pixels = pixels.copy()
+    rgba = pixels.reshape(-1, 4)
     # Check if we have enough bytes to hide the message
-    bytes_needed = math.ceil(len(binary_message) / lsb_bits)
-    if bytes_needed > len(image.getdata()) * 3:
+    if len(symbols) > len(rgba) * 3:
         raise ValueError("Cover file does not have enough data.")
 
-    new_pixels = []
-    for pixel in pixels:
-        if payload_index < binary_message_len:
-            new_pixel = list(pixel)
-
-            # Replace the least significant bit of the red, green, or blue channel with message bits
-            for i in range(3):  # Loop through RGB channels
-                if payload_index < binary_message_len:
-                    bits_to_encode = binary_message[payload_index: payload_index + lsb_bits]
-                    # If there are not enough characters in the binary
-                    # add 0s from the left
-                    if len(bits_to_encode) < lsb_bits:
-                        bits_to_encode = bits_to_encode.ljust(lsb_bits, '0')
-
-                    # get the binary data of the original pixel based on the size of the data we are encoding
-                    if lsb_bits == 8:
-                        new_pixel[i] = int(bits_to_encode, 2)
-                    else:
-                        # get pixel in 8 bit binary
-                        pixel_value_binary = format(new_pixel[i], '08b')
-                        pixel_value_binary = pixel_value_binary[:-lsb_bits] + bits_to_encode
-                        # convert updated string back to int
-                        new_pixel[i] = int(pixel_value_binary, 2)
-
-                    payload_index += lsb_bits
-
-            new_pixels.append(tuple(new_pixel))
-        else:
-            new_pixels.append(pixel)
+    # Replace the least significant bits of the red, green, and blue channels with message symbols
+    embed_pixels(rgba, symbols, lsb_bits)
 
     # Save the modified image
-    encoded_image = Image.new(image.mode, image.size)
-    encoded_image.putdata(new_pixels)
+    encoded_image = Image.fromarray(pixels)
     return encoded_image
 
 
+def png_encode(image_path: str, message: str, lsb_bits=1):
+    """Encodes a message into the PNG image."""
+    image = Image.open(image_path)
+    # image must be in RGB mode  may not be in RGB
+    image = image.convert('RGBA')
+    return png_embed(np.asarray(image), message, lsb_bits)
+
+
+def png_encode_batch(image_path: str, message: str, lsb_levels=range(1, 9)):
+    """
+    Encodes a message into the PNG image once for every lsb count, decoding the image only once.
+    :return: Dictionary of lsb count to the encoded image, or to the exception raised for that lsb count.
+    """
+    image = Image.open(image_path)
+    image = image.convert('RGBA')
+    pixels = np.asarray(image)
+
+    outputs = {}
+    for lsb_bits in lsb_levels:
+        try:
+            outputs[lsb_bits] = png_embed(pixels, message, lsb_bits)
+        except ValueError as e:
+            outputs[lsb_bits] = e
+    return outputs
+
+
 def png_decode(image_path: str, lsb_bits=1):
     """Extract the hidden message from the PNG image."""
     image = Image.open(image_path)
     image = image.convert('RGBA')
 
-    binary_message = []
-    done = False
-    for pixel in image.getdata():
-        if done:
-            break
+    rgba = np.asarray(image).reshape(-1, 4)
+    hidden_message = read_pixels(rgba, lsb_bits).message()
+    return hidden_message
+
+
+def png_decode_all(image_path: str):
+    """
+    Extract the hidden message for every lsb count (1-8) from a single read of the PNG image.
+    :return: Dictionary of lsb count to decoded message.
+    """
+    image = Image.open(image_path)
+    image = image.convert('RGBA')
+
+    rgba = np.asarray(image).reshape(-1, 4)
+    return {lsb: read_pixels(rgba, lsb).message() for lsb in range(1, 9)}
+
+
+class PngRowReader:
+    """
+    Reads the filtered scanlines of a PNG file a band at a time, inflating only what is asked for.
+    Stops at the first chunk after the image data, which is left in next_chunk for the caller to copy.
+    """
 
-        for i in range(3):  # Extract from RGB channels
-            # Extract the least significant 'bits' from the pixel value using binary operations
-            bits_value = pixel[i] & (2 ** lsb_bits - 1)
-            binary_value = format(bits_value, f'0{lsb_bits}b')
-            binary_message.extend(binary_value)
+    def __init__(self, file, idat_length: int, read_size: int):
+        self._file = file
+        self._chunk_left = idat_length
+        self._read_size = read_size
+        self._inflater = zlib.decompressobj()
+        self._buffer = bytearray()
+        self.next_chunk = None
 
-            if delim_check(binary_message):
-                done = True
+    def _next_compressed(self):
+        # Move on to the next IDAT chunk once the current one is used up
+        while self._chunk_left == 0:
+            if self.next_chunk is not None:
+                return b""
+            self._file.read(4)  # CRC of the previous chunk
+            length, chunk_type = struct.unpack(">I4s", self._file.read(8))
+            if chunk_type != b"IDAT":
+                self.next_chunk = (length, chunk_type)
+                return b""
+            self._chunk_left = length
+        data = self._file.read(min(self._read_size, self._chunk_left))
+        self._chunk_left -= len(data)
+        return data
+
+    def read(self, size: int):
+        """
+        :param size: Number of bytes of filtered scanlines to return.
+        """
+        while len(self._buffer) < size:
+            data = self._inflater.unconsumed_tail or self._next_compressed()
+            if not data:
                 break
+            self._buffer += self._inflater.decompress(data, size - len(self._buffer))
+        output = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return output
 
-    hidden_message = bin_to_msg(binary_message)
-    return hidden_message
+    def finish(self):
+        """
+        Skips any image data that is left so the file is positioned at next_chunk.
+        """
+        while self._next_compressed():
+            pass
+
+
+class PngChunkWriter:
+    """
+    Deflates scanlines as they are written and emits them as IDAT chunks of a bounded size.
+    """
+
+    def __init__(self, file, chunk_size: int):
+        self._file = file
+        self._chunk_size = chunk_size
+        self._deflater = zlib.compressobj()
+        self._pending = bytearray()
+
+    def write_chunk(self, chunk_type: bytes, data: bytes):
+        self._file.write(struct.pack(">I", len(data)) + chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    def write_rows(self, data: bytes):
+        self._pending += self._deflater.compress(data)
+        while len(self._pending) >= self._chunk_size:
+            self.write_chunk(b"IDAT", bytes(self._pending[:self._chunk_size]))
+            del self._pending[:self._chunk_size]
+
+    def finish(self):
+        self._pending += self._deflater.flush()
+        if self._pending:
+            self.write_chunk(b"IDAT", bytes(self._pending))
+        self._pending = bytearray()
+
+
+def unfilter_row(filter_type: int, row: np.ndarray, prior: np.ndarray, bpp: int):
+    """
+    Reverses the PNG filter of one scanline.
+    :param filter_type: The filter byte at the start of the scanline.
+    :param row: The filtered bytes of the scanline.
+    :param prior: The unfiltered bytes of the scanline above (all 0s for the first one).
+    :param bpp: Bytes per pixel.
+    :return: The unfiltered bytes of the scanline.
+    """
+    if filter_type == 0:
+        return row.copy()
+    if filter_type == 1:
+        # Sub: each byte adds the byte of the pixel to its left, so a running sum per channel
+        return np.cumsum(row.reshape(-1, bpp), axis=0, dtype=np.uint8).ravel()
+    if filter_type == 2:
+        return row + prior
+
+    # Average and Paeth depend on the bytes already reconstructed, so go byte by byte
+    recon = bytearray(row.tobytes())
+    above = prior.tobytes()
+    for i in range(len(recon)):
+        left = recon[i - bpp] if i >= bpp else 0
+        up = above[i]
+        if filter_type == 3:
+            recon[i] = (recon[i] + ((left + up) >> 1)) & 0xFF
+        else:
+            up_left = above[i - bpp] if i >= bpp else 0
+            p = left + up - up_left
+            pa, pb, pc = abs(p - left), abs(p - up), abs(p - up_left)
+            if pa <= pb and pa <= pc:
+                predictor = left
+            elif pb <= pc:
+                predictor = up
+            else:
+                predictor = up_left
+            recon[i] = (recon[i] + predictor) & 0xFF
+    return np.frombuffer(recon, dtype=np.uint8)
+
+
+def png_encode_stream(image_path: str, output_path: str, message: str, lsb_bits=1,
+                      memory_budget=stream_memory_budget):
+    """
+    Encodes a message into the PNG image and writes it straight to output_path without loading the whole image.
+    Only the rows that hold the payload are unfiltered and modified, the rest of the image data is re-deflated
+    a band at a time, so memory use stays around memory_budget however large the cover is.
+    The channel values written are the same as png_encode, but the colour type of the cover (RGB or RGBA) is kept.
+    Covers that are not 8 bit, non-interlaced RGB/RGBA fall back to png_encode.
+    :param memory_budget: Approximate number of bytes of image data held in memory at once.
+    """
+    # Limits bits to update to only 8
+    if lsb_bits > 8:
+        lsb_bits = 8
+
+    with open(image_path, 'rb') as cover:
+        if cover.read(8) != png_signature:
+            raise ValueError("Cover file is not a PNG image.")
+
+        # Copy every chunk before the image data unchanged
+        header_chunks = []
+        while True:
+            length, chunk_type = struct.unpack(">I4s", cover.read(8))
+            if chunk_type == b"IDAT":
+                break
+            header_chunks.append((chunk_type, cover.read(length)))
+            cover.read(4)  # CRC
+
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", header_chunks[0][1])
+        if bit_depth != 8 or color_type not in (2, 6) or interlace != 0:
+            png_encode(image_path, message, lsb_bits).save(output_path)
+            return True
+
+        bpp = 3 if color_type == 2 else 4
+        stride = width * bpp
+        symbols = msg_to_symbols(message, lsb_bits)
+        if len(symbols) > width * height * 3:
+            raise ValueError("Cover file does not have enough data.")
+
+        # The output is only created once the cover is known to hold the message
+        try:
+            with open(output_path, 'wb') as output:
+                # Rows holding the payload get rewritten unfiltered, as does the row after them
+                # since its filter may refer to the bytes we changed
+                payload_rows = math.ceil(math.ceil(len(symbols) / 3) / width)
+                rewrite_rows = min(payload_rows + 1, height)
+                # Each band is held several times over (filtered, unfiltered, output)
+                band_rows = max(1, memory_budget // (4 * (stride + 1)))
+
+                reader = PngRowReader(cover, length, max(1, memory_budget // 4))
+                writer = PngChunkWriter(output, 1 << 20)
+                output.write(png_signature)
+                for chunk_type, data in header_chunks:
+                    writer.write_chunk(chunk_type, data)
+
+                prior = np.zeros(stride, dtype=np.uint8)
+                row = 0
+                while row < rewrite_rows:
+                    band_end = min(row + band_rows, rewrite_rows)
+                    filtered = np.frombuffer(reader.read((band_end - row) * (stride + 1)), dtype=np.uint8)
+                    filtered = filtered.reshape(-1, stride + 1)
+
+                    band = np.empty((band_end - row, stride), dtype=np.uint8)
+                    for i in range(len(band)):
+                        band[i] = unfilter_row(filtered[i, 0], filtered[i, 1:], prior, bpp)
+                        prior = band[i]
+
+                    # Embed the symbols that belong to this band's channel values
+                    first_symbol = row * width * 3
+                    band_symbols = symbols[first_symbol:band_end * width * 3]
+                    if len(band_symbols) > 0:
+                        prior = prior.copy()
+                        embed_pixels(band.reshape(-1, bpp), band_symbols, lsb_bits)
+
+                    # Filter type 0 in front of every rewritten row
+                    rows_out = np.zeros((len(band), stride + 1), dtype=np.uint8)
+                    rows_out[:, 1:] = band
+                    writer.write_rows(rows_out.tobytes())
+                    row = band_end
 
+                # Everything below is passed through still filtered
+                pass_through = max(stride + 1, band_rows * (stride + 1))
+                while True:
+                    data = reader.read(pass_through)
+                    if not data:
+                        break
+                    writer.write_rows(data)
+                writer.finish()
 
+                # Copy the chunks after the image data (IEND and anything else) unchanged
+                reader.finish()
+                length, chunk_type = reader.next_chunk
+                output.write(struct.pack(">I", length) + chunk_type)
+                shutil.copyfileobj(cover, output)
+        except BaseException:
+            # Do not leave a partial image behind
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+    return True
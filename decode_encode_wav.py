@@ -1,72 +1,267 @@
+import math
+import os
+import shutil
+import struct
 import wave
+
 import numpy as np
 
-def text_to_bin(text):
-    """Convert a string into its binary representation."""
-    return ''.join([format(ord(i), '08b') for i in text])
+from common import msg_to_symbols, PayloadReader, read_all_payloads
+from common import embed_symbols, feed_samples
+
+# Number of frames read and written at a time when streaming a WAV file
+wav_block_frames = 1 << 16
+
+# Header flags recording how the payload is laid out over the frame data
+wav_flag_samples = 0x01
+wav_flag_channel = 0x02
+wav_layout_flags = wav_flag_samples | wav_flag_channel
+
+# Native dtype of each sample width. 24-bit samples have none and are embedded through their low byte
+wav_sample_dtypes = {1: np.uint8, 2: np.dtype('<i2'), 4: np.dtype('<i4')}
+
+def wav_view(data: np.ndarray, sampwidth, nchannels, by_sample=False, channel=None):
+    """
+    Views raw frame bytes as the cover samples the payload is written to, without copying them.
+    :param data: uint8 array of whole frames.
+    :param by_sample: False embeds into every byte, True only into the low bits of each sample.
+    :param channel: With by_sample, only embed into this channel. None interleaves over all channels.
+    :return: Writable 1D view of data if data is writable.
+    """
+    if not by_sample:
+        return data
+    if sampwidth == 3:
+        # Little endian, so the first byte of each sample holds its low bits
+        samples = data.reshape(-1, 3)[:, 0]
+    else:
+        samples = data.view(wav_sample_dtypes[sampwidth])
+    if channel is not None:
+        samples = samples.reshape(-1, nchannels)[:, channel]
+    return samples
+
+def wav_flags(by_sample=False, channel=None):
+    """
+    Header flags for a layout of wav_view.
+    """
+    if not by_sample:
+        return 0
+    return wav_flag_samples | (wav_flag_channel if channel is not None else 0)
+
+def wav_layouts(nchannels):
+    """
+    Every layout a payload may have been embedded with, as (by_sample, channel), in the order decoders try them.
+    """
+    return [(False, None), (True, None)] + [(True, channel) for channel in range(nchannels)]
+
+def symbols_per_frame(sampwidth, nchannels, by_sample=False, channel=None):
+    """
+    Number of symbols each frame holds in a layout of wav_view.
+    """
+    if not by_sample:
+        return sampwidth * nchannels
+    return 1 if channel is not None else nchannels
+
+def wav_blocks(audio, block_frames=wav_block_frames):
+    """
+    Yields the frame data of an open WAV file a block of frames at a time, as uint8 arrays.
+    """
+    while True:
+        block = audio.readframes(block_frames)
+        if not block:
+            break
+        yield np.frombuffer(block, dtype=np.uint8)
 
-def wav_encode(audio_file, message, output_file, bit_depth):
+def wav_embed(frames: bytearray, message, bit_depth, sampwidth=1, nchannels=1, by_sample=False, channel=None):
+    """
+    Embeds the message into the least significant bits of the raw frame data, in place.
+    Only the bytes the message occupies are touched.
+    :param frames: Writable frame data of the cover.
+    :param by_sample: Embed into the low bits of each sampwidth sample instead of every byte, see wav_view.
+    """
+    # Convert the message to symbols with the header in front
+    symbols = msg_to_symbols(message, bit_depth, wav_flags(by_sample, channel))
+    samples = wav_view(np.frombuffer(frames, dtype=np.uint8), sampwidth, nchannels, by_sample, channel)
+
+    # Each byte or sample of the audio file holds one symbol
+    if len(symbols) > len(samples):
+        raise ValueError("Message is too large to embed in the audio file with the selected bit depth.")
+
+    # Clear the lowest bit_depth bits and insert the message symbols, working on the frames without copying them
+    embed_symbols(samples, symbols, bit_depth)
+
+def wav_encode(audio_file, message, output_file, bit_depth, block_frames=wav_block_frames,
+               by_sample=False, channel=None):
+    """
+    Embeds the message into the WAV file, reading and writing block_frames frames at a time
+    so memory use does not depend on the length of the cover.
+    Blocks after the end of the message are copied through unchanged.
+    :param by_sample: Embed into the low bits of each sample instead of every byte, see wav_view.
+    :param channel: With by_sample, only embed into this channel.
+    """
     with wave.open(audio_file, 'rb') as audio:
         params = audio.getparams()
-        frames = bytearray(list(audio.readframes(audio.getnframes())))
 
-        # Convert the message to binary and append the delimiter
-        message_bin = text_to_bin(message) + '1111111111111110'
-        message_len = len(message_bin)
+        # Convert the message to symbols with the header in front
+        symbols = msg_to_symbols(message, bit_depth, wav_flags(by_sample, channel))
 
-        # Total available bits to modify in the audio file
-        total_available_bits = len(frames) * bit_depth
-
-        if message_len > total_available_bits:
+        # Each byte or sample of the audio file holds one symbol
+        per_frame = symbols_per_frame(params.sampwidth, params.nchannels, by_sample, channel)
+        if len(symbols) > params.nframes * per_frame:
             raise ValueError("Message is too large to embed in the audio file with the selected bit depth.")
 
-        # Embed the message into the least significant bits
-        bit_idx = 0
-        for frame_idx in range(len(frames)):
-            current_frame = frames[frame_idx]
-            for bit_pos in range(bit_depth):
-                if bit_idx < message_len:
-                    # Clear the bit at the position bit_pos and insert the message bit
-                    mask = ~(1 << bit_pos)  # Clear bit at bit_pos
-                    current_frame = (current_frame & mask) | (int(message_bin[bit_idx]) << bit_pos)
-                    bit_idx += 1
-                else:
+        # Save the modified frames to the output file
+        with wave.open(output_file, 'wb') as modified_audio:
+            modified_audio.setparams(params)
+
+            payload_index = 0
+            while True:
+                frames = bytearray(audio.readframes(block_frames))
+                if not frames:
                     break
-            frames[frame_idx] = current_frame
+                if payload_index < len(symbols):
+                    # Embed the symbols that belong to this block's samples
+                    samples = wav_view(np.frombuffer(frames, dtype=np.uint8), params.sampwidth, params.nchannels,
+                                       by_sample, channel)
+                    block_symbols = symbols[payload_index:payload_index + len(samples)]
+                    embed_symbols(samples, block_symbols, bit_depth)
+                    payload_index += len(block_symbols)
+                modified_audio.writeframes(frames)
+
+def wav_data_chunk(audio_file):
+    """
+    Finds the data chunk of a WAV file by walking its RIFF chunks.
+    :return: Byte offset of the chunk's sample data in the file and its length in bytes.
+    """
+    file_size = os.path.getsize(audio_file)
+    with open(audio_file, 'rb') as f:
+        riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            raise ValueError("Not a RIFF WAVE file.")
+
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError("WAV file has no data chunk.")
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"data":
+                offset = f.tell()
+                # Streamed files may leave the size unset, so never go past the end of the file
+                return offset, min(chunk_size, file_size - offset)
+            # Chunks are padded to an even number of bytes
+            f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+def wav_encode_in_place(audio_file, message, output_file, bit_depth, by_sample=False, channel=None):
+    """
+    Embeds the message by copying the cover file and patching only the bytes the message occupies.
+    The data chunk of the copy is memory mapped, so the rest of the samples are never read into memory.
+    :param by_sample: Embed into the low bits of each sample instead of every byte, see wav_view.
+    :param channel: With by_sample, only embed into this channel.
+    """
+    with wave.open(audio_file, 'rb') as audio:
+        sampwidth, nchannels = audio.getsampwidth(), audio.getnchannels()
+
+    # Convert the message to symbols with the header in front
+    symbols = msg_to_symbols(message, bit_depth, wav_flags(by_sample, channel))
+
+    offset, size = wav_data_chunk(audio_file)
+    frame_size = sampwidth * nchannels
+    frames_needed = math.ceil(len(symbols) / symbols_per_frame(sampwidth, nchannels, by_sample, channel))
+
+    # Each byte or sample of the audio file holds one symbol
+    if frames_needed > size // frame_size:
+        raise ValueError("Message is too large to embed in the audio file with the selected bit depth.")
+
+    shutil.copyfile(audio_file, output_file)
+
+    # Map only the frames the message occupies
+    frames = np.memmap(output_file, dtype=np.uint8, mode='r+', offset=offset, shape=(frames_needed * frame_size,))
+    try:
+        embed_symbols(wav_view(frames, sampwidth, nchannels, by_sample, channel), symbols, bit_depth)
+        frames.flush()
+    finally:
+        del frames
+
+def wav_encode_batch(audio_file, message, output_files: dict):
+    """
+    Embeds the message once for every bit depth, reading the cover only once.
+    :param output_files: Dictionary of bit depth to the path to write that encoding to.
+    :return: Dictionary of bit depth to True, or to the exception raised for that bit depth.
+    """
+    with wave.open(audio_file, 'rb') as audio:
+        params = audio.getparams()
+        cover_frames = audio.readframes(audio.getnframes())
+
+    outputs = {}
+    for bit_depth, output_file in output_files.items():
+        frames = bytearray(cover_frames)
+        try:
+            wav_embed(frames, message, bit_depth)
+        except ValueError as e:
+            outputs[bit_depth] = e
+            continue
 
-        # Save the modified frames to the output file
         with wave.open(output_file, 'wb') as modified_audio:
             modified_audio.setparams(params)
-            modified_audio.writeframes(bytes(frames))
+            modified_audio.writeframes(frames)
+        outputs[bit_depth] = True
+    return outputs
 
 # Decode
 
-def bin_to_text(binary):
-    """Convert binary string to ASCII text."""
-    message = ''.join([chr(int(binary[i:i+8], 2)) for i in range(0, len(binary), 8)])
-    return message
+def wav_decode_layout(audio, bit_depth, by_sample=False, channel=None, block_frames=wav_block_frames):
+    """
+    Reads the payload embedded with one layout of wav_view from an open WAV file, starting from its first frame.
+    :return: PayloadReader holding the payload, or None if there is no payload in that layout.
+    """
+    sampwidth, nchannels = audio.getsampwidth(), audio.getnchannels()
+    per_frame = symbols_per_frame(sampwidth, nchannels, by_sample, channel)
+    audio.rewind()
 
-def wav_decode(audio_file, bit_depth):
-    """Extract a hidden message from a WAV audio file using specified bits per sample."""
+    # Extract the header first, then only as many samples as the payload needs
+    # Never read more frames than the payload still needs, so reading stops at the payload's last block
+    reader = PayloadReader(bit_depth)
+    while not reader.done:
+        frames_needed = math.ceil(reader.remaining() / per_frame)
+        block = audio.readframes(min(block_frames, frames_needed))
+        if not block:
+            break
+        samples = wav_view(np.frombuffer(block, dtype=np.uint8), sampwidth, nchannels, by_sample, channel)
+        feed_samples(reader, samples)
+
+    if reader.header is None or reader.header.flags & wav_layout_flags != wav_flags(by_sample, channel):
+        return None
+    return reader
+
+def wav_decode(audio_file, bit_depth, block_frames=wav_block_frames):
+    """
+    Extract a hidden message from a WAV audio file using specified bits per sample.
+    Every layout of wav_view is tried in turn, so the layout used to encode does not need to be known.
+    """
     if bit_depth < 1 or bit_depth > 8:
         raise ValueError("bit_depth must be between 1 and 8")
 
     # Open the audio file
     with wave.open(audio_file, 'rb') as audio:
-        frames = bytearray(list(audio.readframes(audio.getnframes())))
-
-        # Extract the bits from each frame based on the bit depth
-        bits = []
-        for frame in frames:
-            for bit_pos in range(bit_depth):
-                bits.append(str((frame >> bit_pos) & 1))  # Extract each of the LSBs based on bit depth
-
-        # Combine all bits into a single string
-        bits = ''.join(bits)
-
-        # Look for the end delimiter ('1111111111111110')
-        end_index = bits.find('1111111111111110')
-        if end_index != -1:
-            message_bits = bits[:end_index]
-            message = bin_to_text(message_bits)
-            return message
\ No newline at end of file
+        for by_sample, channel in wav_layouts(audio.getnchannels()):
+            reader = wav_decode_layout(audio, bit_depth, by_sample, channel, block_frames)
+            if reader is not None:
+                return reader.message()
+    return ""
+
+def wav_decode_all(audio_file, block_frames=wav_block_frames):
+    """Extract the hidden message for every bit depth (1-8) from the WAV audio file, trying every layout."""
+    messages = {bit_depth: "" for bit_depth in range(1, 9)}
+    with wave.open(audio_file, 'rb') as audio:
+        sampwidth, nchannels = audio.getsampwidth(), audio.getnchannels()
+        for by_sample, channel in wav_layouts(nchannels):
+            # Each layout is read in a single pass for every bit depth not found yet
+            audio.rewind()
+            blocks = (wav_view(block, sampwidth, nchannels, by_sample, channel)
+                      for block in wav_blocks(audio, block_frames))
+            readers = read_all_payloads(blocks, [bit_depth for bit_depth, message in messages.items() if not message])
+            for bit_depth, reader in readers.items():
+                if reader.header is not None and reader.header.flags & wav_layout_flags == wav_flags(by_sample, channel):
+                    messages[bit_depth] = reader.message()
+            if all(messages.values()):
+                break
+    return messages
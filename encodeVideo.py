@@ -1,9 +1,18 @@
 import cv2
 import os
+import shutil
+import subprocess
+import tempfile
 from os.path import join
-from moviepy.editor import VideoFileClip
 
-message_delimiter = "\x00"  # End of message delimiter
+from common import msg_to_symbols, embed_symbols
+from frame_pipeline import pipeline_frames, capture_reader
+
+# Header flag set when the payload is packed into all three channels instead of only green
+flag_all_channels = 0x01
+
+# FourCC of the lossless codec written for each output format
+lossless_fourccs = {"AVI": 'FFV1', "MOV": 'png '}
 
 
 def delete_file(input_path):
@@ -15,277 +24,270 @@ def delete_file(input_path):
         print(f"Unable to delete {input_path}. Error: {e}")
         pass
 
-def message_to_bin(message: str):
-    """Convert a string to binary using utf-8 encoding."""
-    return ''.join(format(byte, '08b') for byte in message.encode('utf-8'))
-
-def bin_to_message(binary_data):
-    """Convert binary data back to a UTF-8 string."""
-    byte_chunks = [binary_data[i:i+8] for i in range(0, len(binary_data), 8)]
-    byte_array = bytearray([int(byte, 2) for byte in byte_chunks])
-    return byte_array.decode('utf-8', errors='ignore')
-
-def convert_to_lossless_format(video_file, output_format="AVI"):
+def message_to_symbols(message, lsb_bits, all_channels=False):
     """
-    Converts the input video file to the specified lossless format (AVI with FFV1, MOV with Apple Animation or FFV1).
+    Converts the message to the symbols embedded into the frames, using utf-8 encoding and the payload header.
+    Bytes are embedded as they are.
+    :param all_channels: Recorded in the header flags, so the decoder can tell how the frames were packed.
     """
-    temp_dir = "temp_frames_lossless"
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-
-    # Open the input video file with OpenCV
-    video_capture = cv2.VideoCapture(video_file)
-    if not video_capture.isOpened():
-        raise Exception(f"Failed to open the video file {video_file}")
+    return msg_to_symbols(message, lsb_bits, flag_all_channels if all_channels else 0, 'utf-8')
 
-    frame_count = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
-    frame_width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = video_capture.get(cv2.CAP_PROP_FPS)
-
-    # Conversion to AVI using FFV1 codec
-    if output_format == "AVI":
-        fourcc = cv2.VideoWriter_fourcc(*'FFV1')  # FFV1 codec for lossless AVI
-        output_file = join(temp_dir, "lossless_video.avi")
-        video_writer = cv2.VideoWriter(output_file, fourcc, fps, (frame_width, frame_height))
-
-        for frame_num in range(frame_count):
-            ret, frame = video_capture.read()
-            if not ret:
-                break
-            video_writer.write(frame)
-
-        video_capture.release()
-        video_writer.release()
-        return output_file
-
-    # Conversion to MOV using Apple Animation codec
-    elif output_format == "MOV":
-        fourcc = cv2.VideoWriter_fourcc(*'png ')  # Apple Animation codec for MOV
-        output_file = join(temp_dir, "lossless_video.mov")
-        video_writer = cv2.VideoWriter(output_file, fourcc, fps, (frame_width, frame_height))
-
-        for frame_num in range(frame_count):
-            ret, frame = video_capture.read()
-            if not ret:
-                break
-            video_writer.write(frame)
-
-        video_capture.release()
-        video_writer.release()
-        return output_file
+def payload_plane(frame, all_channels=False):
+    """
+    Flat view of the frame values the payload is written to: the green channel of each pixel,
+    or every channel of each pixel in B, G, R order. Writing to the view writes to the frame.
+    """
+    if all_channels:
+        return frame.reshape(-1)
+    return frame.reshape(-1, 3)[:, 1]
 
-    else:
+def lossless_writer(output_file, output_format, fps, width, height):
+    """
+    Opens a video writer with the lossless codec of the format (AVI with FFV1, MOV with PNG frames).
+    """
+    if output_format not in lossless_fourccs:
         raise ValueError(f"Unsupported lossless format: {output_format}")
+    fourcc = cv2.VideoWriter_fourcc(*lossless_fourccs[output_format])
+    return cv2.VideoWriter(output_file, fourcc, fps, (width, height))
 
-def embed_text_in_frame(frame, binary_message, payload_index, lsb_bits):
+def embed_text_in_frame(frame, symbols, payload_index, lsb_bits, all_channels=False):
     """
-    Embed as much of the binary message into the frame as possible.
+    Embed as much of the message symbols into the frame as possible, in place.
     Returns the updated frame and new payload index.
     """
-    height, width, _ = frame.shape
-    total_bits = len(binary_message)
-    bit_index = payload_index  # Start from the current payload index
-
-    for row in range(height):
-        for col in range(width):
-            if bit_index < total_bits:
-                # Get the bits that we will be appending to the current binary value
-                bits_to_encode = binary_message[bit_index: bit_index + lsb_bits]
-                if len(bits_to_encode) < lsb_bits:
-                    bits_to_encode = bits_to_encode.ljust(lsb_bits, '0')
-
-                # Modify the blue channel's LSBs to store the message
-                green = frame[row, col, 1]
-                green_binary = format(green, '08b')
-                green_binary = green_binary[:-lsb_bits] + bits_to_encode
-                frame[row, col, 1] = int(green_binary, 2)
-
-                # Print the binary being encoded
-                # if bit_index % 8 == 0:
-                #     char_being_encoded = bin_to_message(binary_message[bit_index: bit_index + 8])
-                #     print(f"Embedding '{char_being_encoded}' in frame pixel ({row}, {col})")
-
-                bit_index += lsb_bits
-            else:
-                # Once the message is fully embedded, return the updated frame and new payload index
-                return frame, bit_index
-
-    return frame, bit_index
+    # Clear the LSBs of the payload plane and write this frame's share of the symbols in one go
+    plane = payload_plane(frame, all_channels)
+    frame_symbols = symbols[payload_index:payload_index + len(plane)]
+    embed_symbols(plane, frame_symbols, lsb_bits)
+    return frame, payload_index + len(frame_symbols)
 
-def encode_video_with_cv2(video_file, text_file, output_path, lsb_bits=1, selected_format="AVI"):
+def encode_video_with_cv2(video_file, text_file, output_path, lsb_bits=1, selected_format="AVI", all_channels=False):
     """
     Encode a message into the video by modifying the pixel values using the LSB technique.
-    Prints the character being embedded in each frame during the embedding process.
     Handles both ASCII and non-ASCII characters.
+    :param all_channels: Pack the message into all three channels instead of only green, touching a third of the frames.
     """
     # Read the text payload (supports non-ASCII characters with UTF-8 encoding)
     with open(text_file, 'r', encoding="utf-8") as f:
-        payload = f.read() + message_delimiter  # Add the delimiter at the end of the message
+        payload = f.read()
 
-    binary_message = message_to_bin(payload)  # Convert the message to binary
-    payload_index = 0  # Start embedding from the first bit of the binary message
-    binary_message_len = len(binary_message)
+    symbols = message_to_symbols(payload, lsb_bits, all_channels)  # Convert the message to symbols
+    payload_index = 0  # Start embedding from the first symbol of the message
+    symbols_len = len(symbols)
 
-    # Convert video to selected lossless format
-    lossless_path = convert_to_lossless_format(video_file, output_format=selected_format)
+    if selected_format not in lossless_fourccs:
+        raise ValueError(f"Unsupported lossless format: {selected_format}")
 
-    # Open the video file
-    video_capture = cv2.VideoCapture(lossless_path)
+    # Read the source video directly, the lossless codec is applied as the embedded frames are written
+    video_capture = cv2.VideoCapture(video_file)
+    if not video_capture.isOpened():
+        raise Exception(f"Failed to open the video file {video_file}")
     fps = video_capture.get(cv2.CAP_PROP_FPS)
     width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
     frame_count = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
 
-    # Create a video writer to save the modified video
-    fourcc = cv2.VideoWriter_fourcc(*'FFV1') if selected_format == "AVI" else cv2.VideoWriter_fourcc(*'png ')
-    output_file = f"{output_path}.{selected_format.lower()}"
-    video_writer = cv2.VideoWriter(output_file, fourcc, fps, (width, height))
+    if symbols_len > frame_count * width * height * (3 if all_channels else 1):
+        video_capture.release()
+        raise ValueError("Cover file does not have enough data.")
 
-    while video_capture.isOpened() and payload_index < binary_message_len:
-        ret, frame = video_capture.read()
-        if not ret:
-            break
+    extension = selected_format.lower()
+    output_file = f"{output_path}.{extension}"
+    final_output_path = f"{output_path}_with_audio.{extension}"
 
-        # Embed as much of the message as possible into the frame
-        frame, payload_index = embed_text_in_frame(frame, binary_message, payload_index, lsb_bits)
+    # The soundless video is only an intermediate, so it goes to a directory of its own for this job
+    with tempfile.TemporaryDirectory(prefix="encode_video_") as temp_dir:
+        soundless_video_path = join(temp_dir, f"soundless.{extension}")
+        video_writer = lossless_writer(soundless_video_path, selected_format, fps, width, height)
 
-        # Write the modified frame to the output video
-        video_writer.write(frame)
+        frames_written = 0
 
-        if payload_index >= binary_message_len:
-            print(f"Message fully embedded after {frame_count} frames.")
-            break
+        def embed(frame):
+            nonlocal payload_index, frames_written
+            # Stop writing frames once the message is fully embedded
+            if payload_index >= symbols_len:
+                return None
+            # Embed as much of the message as possible into the frame
+            frame, payload_index = embed_text_in_frame(frame, symbols, payload_index, lsb_bits, all_channels)
+            frames_written += 1
+            if payload_index >= symbols_len:
+                print(f"Message fully embedded after {frames_written} frames.")
+            return frame
+
+        # Decoding, embedding and writing the modified frames to the output video overlap on separate threads
+        try:
+            pipeline_frames(capture_reader(video_capture), embed, video_writer.write, (height, width, 3))
+        finally:
+            video_capture.release()
+            video_writer.release()
+
+        # The frame count is only the container's estimate, so the video may still have ended before the payload
+        if payload_index < symbols_len:
+            raise ValueError("Cover file does not have enough data.")
+
+        # Now, add audio back to the video, copying both streams as they are
+        audio_added = mux_audio(video_file, soundless_video_path, final_output_path)
+        if not audio_added:
+            shutil.move(soundless_video_path, output_file)
 
-    video_capture.release()
-    video_writer.release()
+    print("Encoding completed.")
+
+    return final_output_path if audio_added else output_file
 
-    # Now, add audio back to the video using MoviePy
+def has_audio(video_file):
+    """
+    Checks whether the video has an audio stream, from the stream list ffmpeg prints for it.
+    :return: True if there is an audio stream, False if there is none or ffmpeg could not be run.
+    """
     try:
-        original_clip = VideoFileClip(video_file)
-        if original_clip.audio:
-            print("Adding audio back to the encoded video...")
-            encoded_clip = VideoFileClip(output_file)
-            video_with_audio = encoded_clip.set_audio(original_clip.audio)
-            final_output_path = f"{output_path}_with_audio.{selected_format.lower()}"
-            video_with_audio.write_videofile(final_output_path, codec="ffv1" if selected_format == "AVI" else "png", preset="ultrafast")
-            return final_output_path
-        else:
-            print("No audio found in the original video.")
-    except Exception as e:
-        print(f"Error adding audio or writing video: {e}")
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-i", video_file],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except OSError as e:
+        print(f"Unable to read the streams of {video_file}: {e}")
+        return False
+    return any(line.lstrip().startswith("Stream #") and ": Audio:" in line
+               for line in result.stderr.decode(errors='replace').splitlines())
 
-    print("Encoding completed.")
+def mux_audio(video_file, encoded_video_path, output_path):
+    """
+    Writes the encoded video and the audio of the original video into output_path with ffmpeg.
+    The video is stream copied, and so is the audio unless the container cannot hold it, in which case it becomes AAC.
+    :return: True if the audio was added, False if the original has no audio, it could not be added
+             or ffmpeg could not be run. Nothing is written to output_path then.
+    """
+    if not has_audio(video_file):
+        print("The original video has no audio, keeping the encoded video as it is.")
+        return False
+
+    for audio_codec in ["copy", "aac"]:
+        command = ["ffmpeg", "-y", "-loglevel", "error", "-i", encoded_video_path, "-i", video_file,
+                   "-map", "0:v", "-map", "1:a?", "-c:v", "copy", "-c:a", audio_codec, output_path]
+        try:
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except OSError as e:
+            print(f"Unable to add audio: {e}")
+            return False
+        if result.returncode == 0:
+            print("Added audio back to the encoded video.")
+            return True
+        print(f"Unable to add audio with codec {audio_codec}: {result.stderr.decode(errors='replace').strip()}")
+    return False
+
+def add_audio(video_file, soundless_video_path, output_path):
+    """
+    Adds the audio of the original video to the encoded video without re-encoding the video,
+    and deletes the soundless video. If the audio cannot be added, the soundless video becomes the output.
+    """
+    if mux_audio(video_file, soundless_video_path, output_path):
+        delete_file(soundless_video_path)
+        return output_path
 
-    return output_file
+    os.replace(soundless_video_path, output_path)
+    return output_path
 
-def avi_encode(video_file, payload_content, output_path, lsb_bits=1):
+def encode_lossless(video_file, payload_content, output_path, lsb_bits=1, all_channels=False):
     """
-    Converts the video to a lossless format (AVI or MOV) and embeds text into the video frames using LSB steganography.
+    Embeds text into the video frames using LSB steganography and saves them with the lossless FFV1 codec.
+    :param all_channels: Pack the text into all three channels instead of only green, touching a third of the frames.
     """
 
-    binary_message = message_to_bin(payload_content)  # Convert the message to binary
-    binary_message_len = len(binary_message)
-    payload_index = 0  # Start embedding from the first bit of the binary message
+    symbols = message_to_symbols(payload_content, lsb_bits, all_channels)  # Convert the message to symbols
+    symbols_len = len(symbols)
+    payload_index = 0  # Start embedding from the first symbol of the message
 
     # Open the video file
     cap = cv2.VideoCapture(video_file)
     fps = cap.get(cv2.CAP_PROP_FPS)
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    if symbols_len > frame_count * width * height * (3 if all_channels else 1):
+        cap.release()
+        raise ValueError("Cover file does not have enough data.")
 
     # Create a video writer to save the modified video
     fourcc = cv2.VideoWriter_fourcc(*'FFV1')
-    soundless_video_path = output_path.replace(".avi", "_temp.avi")
+    base, extension = os.path.splitext(output_path)
+    soundless_video_path = f"{base}_temp{extension}"
     out = cv2.VideoWriter(soundless_video_path, fourcc, fps, (width, height))
 
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        if payload_index < binary_message_len:
+    def embed(frame):
+        nonlocal payload_index
+        if payload_index < symbols_len:
             # Embed as much of the message as possible into the frame
-            frame, payload_index = embed_text_in_frame(frame, binary_message, payload_index, lsb_bits)
+            frame, payload_index = embed_text_in_frame(frame, symbols, payload_index, lsb_bits, all_channels)
+        return frame
 
-        # Write the modified frame to the output video
-        out.write(frame)
-
-    cap.release()
-    out.release()
-
-    # Now, add audio back to the video using MoviePy
+    # Decoding, embedding and writing the modified frames to the output video overlap on separate threads
     try:
-        original_clip = VideoFileClip(video_file)
-        if original_clip.audio:
-            print("Adding audio back to the encoded video...")
-            encoded_clip = VideoFileClip(soundless_video_path)
-            video_with_audio = encoded_clip.set_audio(original_clip.audio)
-            video_with_audio.write_videofile(output_path, codec="ffv1", preset="ultrafast")
-            return output_path
-        else:
-            print("No audio found in the original video.")
-    except Exception as e:
-        print(f"Error adding audio or writing video: {e}")
+        pipeline_frames(capture_reader(cap), embed, out.write, (height, width, 3))
+    finally:
+        cap.release()
+        out.release()
 
+    # Now, add audio back to the video
+    add_audio(video_file, soundless_video_path, output_path)
     print("Encoding completed.")
 
-    delete_file(soundless_video_path)
-
     return output_path
 
-
-def mov_encode(video_file, payload_content, output_path, lsb_bits=1):
+def encode_lossless_batch(video_file, payload_content, output_paths: dict, all_channels=False):
     """
-    Converts the video to a lossless format (MOV) and embeds text into the video frames using LSB steganography.
+    Embeds the text once for every lsb count, decoding each frame of the cover only once.
+    Every decoded frame is embedded into and written to one video writer per lsb count.
+    :param output_paths: Dictionary of lsb count to the path (.avi or .mov) to write that encoding to.
+    :return: Dictionary of lsb count to output path, or to the exception raised for that lsb count.
     """
-
-    binary_message = message_to_bin(payload_content)  # Convert the message to binary
-    binary_message_len = len(binary_message)
-    payload_index = 0  # Start embedding from the first bit of the binary message
-
-    # Open the video file
     cap = cv2.VideoCapture(video_file)
     fps = cap.get(cv2.CAP_PROP_FPS)
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-    # Create a video writer to save the modified video
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     fourcc = cv2.VideoWriter_fourcc(*'FFV1')
-    soundless_video_path = output_path.replace(".mov", "_temp.mov")
-    out = cv2.VideoWriter(soundless_video_path, fourcc, fps, (width, height))
 
-    while cap.isOpened():
+    # writer, symbols, payload index and soundless path for each lsb count
+    outputs = {}
+    encoders = {}
+    for lsb_bits, output_path in output_paths.items():
+        symbols = message_to_symbols(payload_content, lsb_bits, all_channels)
+        if len(symbols) > frame_count * width * height * (3 if all_channels else 1):
+            outputs[lsb_bits] = ValueError("Cover file does not have enough data.")
+            continue
+        base, extension = os.path.splitext(output_path)
+        soundless_video_path = f"{base}_temp{extension}"
+        out = cv2.VideoWriter(soundless_video_path, fourcc, fps, (width, height))
+        encoders[lsb_bits] = [out, symbols, 0, soundless_video_path]
+
+    while cap.isOpened() and encoders:
         ret, frame = cap.read()
         if not ret:
             break
 
-        if payload_index < binary_message_len:
-            # Embed as much of the message as possible into the frame
-            frame, payload_index = embed_text_in_frame(frame, binary_message, payload_index, lsb_bits)
-
-        # Write the modified frame to the output video
-        out.write(frame)
+        for lsb_bits, encoder in encoders.items():
+            out, symbols, payload_index, _ = encoder
+            if payload_index < len(symbols):
+                encoded_frame, encoder[2] = embed_text_in_frame(frame.copy(), symbols, payload_index, lsb_bits,
+                                                                all_channels)
+                out.write(encoded_frame)
+            else:
+                out.write(frame)
 
     cap.release()
-    out.release()
+    for lsb_bits, (out, _, _, soundless_video_path) in encoders.items():
+        out.release()
+        outputs[lsb_bits] = add_audio(video_file, soundless_video_path, output_paths[lsb_bits])
+    return outputs
 
-    # Now, add audio back to the video using MoviePy
-    try:
-        original_clip = VideoFileClip(video_file)
-        if original_clip.audio:
-            print("Adding audio back to the encoded video...")
-            encoded_clip = VideoFileClip(soundless_video_path)
-            video_with_audio = encoded_clip.set_audio(original_clip.audio)
-            video_with_audio.write_videofile(output_path, codec="ffv1", preset="ultrafast")
-            return output_path
-        else:
-            print("No audio found in the original video.")
-    except Exception as e:
-        print(f"Error adding audio or writing video: {e}")
-
-    print("Encoding completed.")
+def avi_encode(video_file, payload_content, output_path, lsb_bits=1, all_channels=False):
+    """
+    Converts the video to a lossless format (AVI or MOV) and embeds text into the video frames using LSB steganography.
+    """
+    return encode_lossless(video_file, payload_content, output_path, lsb_bits, all_channels)
 
-    delete_file(soundless_video_path)
 
-    return output_path
+def mov_encode(video_file, payload_content, output_path, lsb_bits=1, all_channels=False):
+    """
+    Converts the video to a lossless format (MOV) and embeds text into the video frames using LSB steganography.
+    """
+    return encode_lossless(video_file, payload_content, output_path, lsb_bits, all_channels)
@@ -0,0 +1,157 @@
+import queue
+import subprocess
+import threading
+
+import numpy as np
+
+# Number of frame buffers cycled between the reader, embed and writer stages
+frame_ring_size = 6
+
+
+def pipeline_frames(read_frame, process_frame, write_frame, frame_shape, ring_size=frame_ring_size):
+    """
+    Runs the frames of a video through read, process and write stages that overlap on separate threads.
+    Frames are read on a reader thread, processed on the calling thread and written on a writer thread,
+    handed between them by queues. Only ring_size frame buffers exist, and the writer returns each one to the
+    reader once written, so at most ring_size frames are in flight and nothing is allocated per frame.
+    Decoding and encoding in OpenCV and writing to a pipe release the GIL, so the stages run in parallel.
+    :param read_frame: Called with a free buffer of frame_shape. Returns the frame read (normally into the buffer),
+    or None at the end of the video.
+    :param process_frame: Called with each frame in order. Returns the frame to write, or None to stop
+    without writing any more frames.
+    :param write_frame: Called with each frame to write, in order.
+    """
+    free_buffers = queue.Queue()
+    for _ in range(ring_size):
+        free_buffers.put(np.empty(frame_shape, dtype=np.uint8))
+    # Never more than ring_size frames plus the end marker in either queue
+    read_frames = queue.Queue(ring_size + 1)
+    processed_frames = queue.Queue(ring_size + 1)
+
+    errors = []
+    stop = threading.Event()
+
+    def stop_reader():
+        stop.set()
+        # Wakes the reader if it is waiting for a free buffer
+        free_buffers.put(None)
+
+    def reader():
+        try:
+            while not stop.is_set():
+                buffer = free_buffers.get()
+                if buffer is None:
+                    break
+                frame = read_frame(buffer)
+                if frame is None:
+                    break
+                read_frames.put(frame)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            read_frames.put(None)
+
+    def writer():
+        try:
+            while True:
+                frame = processed_frames.get()
+                if frame is None:
+                    break
+                write_frame(frame)
+                free_buffers.put(frame)
+        except BaseException as e:
+            errors.append(e)
+            stop_reader()
+
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    reader_thread.start()
+    writer_thread.start()
+    try:
+        while True:
+            frame = read_frames.get()
+            if frame is None:
+                break
+            frame = process_frame(frame)
+            if frame is None:
+                stop_reader()
+                break
+            processed_frames.put(frame)
+    except BaseException as e:
+        errors.append(e)
+        stop_reader()
+    finally:
+        processed_frames.put(None)
+        writer_thread.join()
+        # Let the reader finish if it is still putting frames nobody will take
+        while reader_thread.is_alive():
+            try:
+                read_frames.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        reader_thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def capture_reader(cap):
+    """
+    A read_frame for pipeline_frames that decodes the next frame of a cv2.VideoCapture into the given buffer.
+    """
+    def read_frame(buffer):
+        ret, frame = cap.read(buffer)
+        return frame if ret else None
+    return read_frame
+
+
+def frame_reader(input_path, width, height, start_time=None, frame_count=None):
+    """
+    Yields the frames of a video as BGR arrays, decoded by an ffmpeg process.
+    :param start_time: Timestamp in microseconds of the first frame to yield,
+    as given by decode_encode_mkv.frame_timestamps.
+    ffmpeg seeks to the keyframe before it and only decodes from there, dropping the frames before the timestamp.
+    None starts from the first frame.
+    :param frame_count: Number of frames to yield, None reads to the end of the video.
+    """
+    command = ["ffmpeg", "-loglevel", "error"]
+    if start_time is not None:
+        command += ["-ss", f"{start_time // 1000000}.{start_time % 1000000:06d}"]
+    command += ["-i", input_path, "-map", "0:v:0"]
+    if frame_count is not None:
+        command += ["-frames:v", str(frame_count)]
+    command += ["-vsync", "passthrough", "-f", "rawvideo", "-pix_fmt", "bgr24", "-"]
+
+    reader = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            frame = np.empty((height, width, 3), dtype=np.uint8)
+            if reader.stdout.readinto(frame.data) < frame.nbytes:
+                break
+            yield frame
+    finally:
+        reader.stdout.close()
+        reader.kill()
+        reader.wait()
+
+
+def plane_reader(input_path, plane, width, height):
+    """
+    Yields one colour plane of each frame of a video as a flat array, decoded by an ffmpeg process that converts
+    the frames to planar gbrp and only sends the requested plane.
+    The same preallocated array is filled and yielded for every frame, so copy anything that has to outlive it.
+    :param plane: "b", "g" or "r".
+    """
+    command = ["ffmpeg", "-loglevel", "error", "-i", input_path, "-map", "0:v:0",
+               "-vf", f"format=gbrp,extractplanes={plane}",
+               "-vsync", "passthrough", "-f", "rawvideo", "-pix_fmt", "gray", "-"]
+
+    reader = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        buffer = np.empty(width * height, dtype=np.uint8)
+        while reader.stdout.readinto(buffer.data) == buffer.nbytes:
+            yield buffer
+    finally:
+        reader.stdout.close()
+        reader.kill()
+        reader.wait()
@@ -0,0 +1,180 @@
+import os
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+from common import worker_context
+from decode_encode_png import png_embed, png_encode_batch
+from decode_encode_wav import wav_embed, wav_encode_batch
+from decode_encode_flac import flac_embed, flac_encode_batch, flac_read, flac_write
+from decode_encode_mkv import mkv_encode, mkv_encode_batch
+from encodeVideo import encode_lossless, encode_lossless_batch
+
+# Number of worker processes used to encode the LSB levels
+max_workers = os.cpu_count() or 1
+
+
+class SharedCover:
+    """
+    A decoded cover array placed in shared memory, so worker processes can read it without it being pickled.
+    """
+    name: str
+    shape: tuple
+    dtype: str
+
+    def __init__(self, array: np.ndarray):
+        self._memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.name = self._memory.name
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self._memory.buf)[...] = array
+
+    def __getstate__(self):
+        # Only the name of the block is sent to the workers
+        return {"name": self.name, "shape": self.shape, "dtype": self.dtype}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._memory = None
+
+    def open(self):
+        """
+        Attaches to the shared block from a worker process.
+        :return: The shared memory block and a read only array view of it. Close the block once done.
+        """
+        try:
+            memory = shared_memory.SharedMemory(name=self.name, track=False)
+        except TypeError:
+            # Python < 3.13 has no track argument
+            memory = shared_memory.SharedMemory(name=self.name)
+        array = np.ndarray(self.shape, dtype=self.dtype, buffer=memory.buf)
+        array.flags.writeable = False
+        return memory, array
+
+    def release(self):
+        """
+        Frees the shared block. Only call from the process that created it.
+        """
+        self._memory.close()
+        self._memory.unlink()
+
+
+def png_job(cover: SharedCover, message, lsb_bits, output_path):
+    memory, pixels = cover.open()
+    try:
+        png_embed(pixels, message, lsb_bits).save(output_path)
+    finally:
+        del pixels
+        memory.close()
+    return output_path
+
+
+def wav_job(cover: SharedCover, params, message, bit_depth, output_path):
+    memory, frames = cover.open()
+    try:
+        encoded_frames = bytearray(frames)
+    finally:
+        del frames
+        memory.close()
+
+    wav_embed(encoded_frames, message, bit_depth)
+    with wave.open(output_path, 'wb') as modified_audio:
+        modified_audio.setparams(params)
+        modified_audio.writeframes(encoded_frames)
+    return output_path
+
+
+def flac_job(cover: SharedCover, samplerate, subtype, message, lsb_bits, output_path):
+    memory, data = cover.open()
+    try:
+        flac_write(output_path, flac_embed(data, message, lsb_bits), samplerate, subtype)
+    finally:
+        del data
+        memory.close()
+    return output_path
+
+
+def mkv_job(cover_path, message, lsb_bits, output_path):
+    mkv_encode(cover_path, output_path, message, lsb_bits)
+    return output_path
+
+
+def lossless_job(cover_path, message, lsb_bits, output_path):
+    return encode_lossless(cover_path, message, output_path, lsb_bits)
+
+
+def batch_encode(selected_format, cover_path, message, output_paths: dict):
+    """
+    Encodes every LSB level in this process, decoding the cover only once.
+    :return: Dictionary of lsb count to output path, or to the exception raised for that lsb count.
+    """
+    if selected_format == "png":
+        results = png_encode_batch(cover_path, message, output_paths.keys())
+        for lsb_bits, output in results.items():
+            if not isinstance(output, Exception):
+                output.save(output_paths[lsb_bits])
+    elif selected_format == "wav":
+        results = wav_encode_batch(cover_path, message, output_paths)
+    elif selected_format == "flac":
+        results = flac_encode_batch(cover_path, output_paths, message)
+    elif selected_format == "mkv":
+        results = mkv_encode_batch(cover_path, output_paths, message)
+    elif selected_format in ["avi", "mov"]:
+        results = encode_lossless_batch(cover_path, message, output_paths)
+    else:
+        raise ValueError(f"Unsupported format: {selected_format}")
+
+    return {lsb_bits: output if isinstance(output, Exception) else output_paths[lsb_bits]
+            for lsb_bits, output in results.items()}
+
+
+def parallel_encode(selected_format, cover_path, message, output_paths: dict, workers=None):
+    """
+    Encodes every LSB level in its own worker process.
+    Image and audio covers are decoded once and shared with the workers through shared memory,
+    video workers each read the cover file themselves.
+    :param output_paths: Dictionary of lsb count to the path to write that encoding to.
+    :param workers: Number of worker processes, defaults to max_workers. 1 encodes in this process instead.
+    :return: Dictionary of lsb count to output path, or to the exception raised for that lsb count.
+    """
+    workers = workers or max_workers
+    if workers <= 1:
+        return batch_encode(selected_format, cover_path, message, output_paths)
+
+    cover = None
+    if selected_format == "png":
+        image = Image.open(cover_path).convert('RGBA')
+        cover = SharedCover(np.asarray(image))
+        jobs = {lsb_bits: (png_job, cover, message, lsb_bits, path) for lsb_bits, path in output_paths.items()}
+    elif selected_format == "wav":
+        with wave.open(cover_path, 'rb') as audio:
+            params = audio.getparams()
+            cover = SharedCover(np.frombuffer(audio.readframes(audio.getnframes()), dtype=np.uint8))
+        jobs = {lsb_bits: (wav_job, cover, params, message, lsb_bits, path) for lsb_bits, path in output_paths.items()}
+    elif selected_format == "flac":
+        data, samplerate, subtype = flac_read(cover_path)
+        cover = SharedCover(data)
+        jobs = {lsb_bits: (flac_job, cover, samplerate, subtype, message, lsb_bits, path)
+                for lsb_bits, path in output_paths.items()}
+    elif selected_format == "mkv":
+        jobs = {lsb_bits: (mkv_job, cover_path, message, lsb_bits, path) for lsb_bits, path in output_paths.items()}
+    elif selected_format in ["avi", "mov"]:
+        jobs = {lsb_bits: (lossless_job, cover_path, message, lsb_bits, path)
+                for lsb_bits, path in output_paths.items()}
+    else:
+        raise ValueError(f"Unsupported format: {selected_format}")
+
+    results = {}
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=worker_context) as pool:
+            futures = {lsb_bits: pool.submit(*job) for lsb_bits, job in jobs.items()}
+            for lsb_bits, future in futures.items():
+                error = future.exception()
+                results[lsb_bits] = error if error is not None else future.result()
+    finally:
+        if cover is not None:
+            cover.release()
+    return results
@@ -6,13 +6,14 @@ import os
 import io
 import tempfile
 
-from decode_encode_png import png_decode, png_encode
-from decode_encode_wav import wav_decode, wav_encode
+from decode_encode_png import png_decode, png_encode, png_decode_all
+from decode_encode_wav import wav_decode, wav_encode_in_place, wav_decode_all
 from decode_encode_wav_payload import WAVPayload, isWavPayload
 from decode_encode_png_payload import PNGPayload, isPngPayload
-from decode_encode_flac import flac_decode, flac_encode
-from decode_encode_mkv import mkv_encode, mkv_decode
+from decode_encode_flac import flac_decode, flac_encode, flac_decode_all
+from decode_encode_mkv import mkv_encode, mkv_decode, mkv_decode_all
 from encodeVideo import avi_encode, mov_encode
+from multi_encode import parallel_encode
 from decodeVideo import decode_video_with_cv2
 from encoder import encode_image
 from audio_spectrogram import plot_spectrogram
@@ -34,12 +35,12 @@ def create_temp_file(file, extension):
         return temp_file_path
 
 
-def create_temp_text_file(text: str):
+def create_temp_text_file(text):
     # Create a temporary file
-    temp_file = tempfile.NamedTemporaryFile(delete=False, mode='w', encoding='ascii', suffix='.txt')
+    temp_file = tempfile.NamedTemporaryFile(delete=False, mode='wb', suffix='.txt')
 
-    # Write the string to the temporary file
-    temp_file.write(text)
+    # Write the string, or the bytes of a binary payload, to the temporary file
+    temp_file.write(text if isinstance(text, bytes) else text.encode('ascii'))
 
     # Save the file name and close the file
     temp_file_path = temp_file.name
@@ -123,12 +124,12 @@ def encode_section_choose_files():
             elif payload_file.type in ["audio/wav"]:
                 WavData = WAVPayload.readFromPath(payload_file)
                 payload_content = WavData.convertToPayload()
-                st.text_area("Complete File Content:", payload_content, height=25)
+                st.write(f"WAV payload: {len(payload_content)} bytes")
                 st.audio(payload_file)
             elif payload_file.type in ["image/png"]:
                 PngData = PNGPayload.readFromPath(payload_file)
                 payload_content = PngData.convertToPayload()
-                st.text_area("Complete File Content:", payload_content, height=25)
+                st.write(f"PNG payload: {len(payload_content)} bytes")
                 st.image(payload_file)
 
     # File uploader for Cover
@@ -207,7 +208,7 @@ def encode_section_single_encode(cover_file, payload_file, encode_slider, select
                         flac_encode(tempfile, output_path, payload_content, encode_slider)
                     elif selected_format == "wav":
                         output_path = f"output/{filename}.{encode_slider}.wav"
-                        wav_encode(tempfile, payload_content, output_path, encode_slider)
+                        wav_encode_in_place(tempfile, payload_content, output_path, encode_slider)
                     elif selected_format == "mkv":
                         output_path = f"output/{filename}.{encode_slider}.mkv"
                         mkv_encode(tempfile, output_path, payload_content, encode_slider)
@@ -300,55 +301,33 @@ def encode_section_multi_encode(cover_file, payload_file, selected_format):
                 tempfile = convert_cover_to_selected_format(cover_file, selected_format)
                 selected_format = selected_format.lower()
 
-                for i in range(1, 9):
-                    # Encode the file for each LSB
-                    # Save all those generated files to output folder
-                    # store paths for each file
-                    # Use those paths to generate slideshow
-                    try:
-                        if selected_format in ["png"]:
-                            output = png_encode(tempfile, payload_content, i)
-                            # png_encode will return bool during failure
-                            output_list.append(output)
-                            # Save image to local storage to download the file
-                            output_path = f"output/{filename}.{i}.png"
-                            output.save(output_path)
-                            output_paths.append(output_path)
-                        elif selected_format in ["jpg", "jpeg"]:
+                # Encode the file for each LSB, each one in its own worker process
+                # Save all those generated files to output folder
+                # store paths for each file
+                # Use those paths to generate slideshow
+                lsb_levels = range(1, 9)
+                extension = "png" if selected_format in ["jpg", "jpeg"] else selected_format
+                paths = {i: f"output/{filename}.{i}.{extension}" for i in lsb_levels}
+                results = {}
+                try:
+                    if selected_format in ["jpg", "jpeg"]:
+                        for i in lsb_levels:
                             output = encode_image(tempfile, temp_text_file, i)
-                            output_list.append(output)
                             # Save image to local storage to download the file
-                            output_path = f"output/{filename}.{i}.png"
-                            output.save(output_path)
-                        elif selected_format == "wav":
-                            # st.write("path done")
-                            cover_file = io.BytesIO(cover_file.getvalue())  # Reset file stream for each loop iteration
-                            output_path = f"output/{filename}.{i}.wav"
-                            output = wav_encode(tempfile, payload_content, output_path, i)
-                            output_list.append(output)
-                            output_paths.append(output_path)
-                        elif selected_format == "flac":
-                            output_path = f"output/{filename}.{i}.flac"
-                            output = flac_encode(tempfile, output_path, payload_content, i)
-                            output_list.append(output)
-                            output_paths.append(output_path)
-                        elif selected_format == "mkv":
-                            output_path = f"output/{filename}.{i}.mkv"
-                            output = mkv_encode(tempfile, output_path, payload_content, i)
-                            output_paths.append(output_path)
-                            output_list.append(output)
-                        elif selected_format == "avi":
-                            output_path = f"output/{filename}.{i}.avi"
-                            output = avi_encode(tempfile, payload_content, output_path, i)
-                            output_paths.append(output_path)
-                            output_list.append(output)
-                        elif selected_format == "mov":
-                            output_path = f"output/{filename}.{i}.mov"
-                            output = mov_encode(tempfile, payload_content, output_path, i)
-                            output_paths.append(output_path)
-                            output_list.append(output)
-                    except Exception as e:
-                        st.error(f"Error encoding {selected_format} file: {e}")
+                            output.save(paths[i])
+                            results[i] = output
+                    else:
+                        # Images are previewed from their saved paths
+                        results = parallel_encode(selected_format, tempfile, payload_content, paths)
+                except Exception as e:
+                    st.error(f"Error encoding {selected_format} file: {e}")
+
+                for i, output in results.items():
+                    if isinstance(output, Exception):
+                        st.error(f"Error encoding {selected_format} file with {i} LSB: {output}")
+                        continue
+                    output_list.append(output)
+                    output_paths.append(paths[i])
 
     # Download button
     with col2:
@@ -521,7 +500,7 @@ def decode_section():
 
                 if isWavPayload(decoded_content):
                     decoded_wav_path = f"output/{encoded_file.name[:-4]}_decoded.wav"
-                    WAVPayload.readFromString(decoded_content, decoded_wav_path)
+                    WAVPayload.readFromBytes(decoded_content, decoded_wav_path)
                     st.audio(decoded_wav_path)
                     st.download_button("Download Decoded WAV",
                                        data=open(decoded_wav_path, 'rb').read(),
@@ -530,14 +509,14 @@ def decode_section():
 
                 if isPngPayload(decoded_content):
                     decoded_img_path = f"output/{encoded_file.name[:-4]}_decoded.png"
-                    PNGPayload.readFromString(decoded_content, decoded_img_path)
+                    PNGPayload.readFromBytes(decoded_content, decoded_img_path)
                     st.image(decoded_img_path)
                     st.download_button("Download Decoded PNG",
                                        data=open(decoded_img_path, 'rb').read(),
                                        file_name=decoded_img_path,
                                        key='download-decoded-img')
 
-                st.text_area("Complete File Content:", decoded_content, height=25, key="decode-text-area")
+                st.text_area("Complete File Content:", payload_text(decoded_content), height=25, key="decode-text-area")
 
         if st.button("Decode File (guess LSB)", key='decode-button-guess'):
 
@@ -547,10 +526,8 @@ def decode_section():
 
                 if extension == "png":
                     try:
-                        # Attempt decoding from 1 to 8 LSBs for PNG
-                        for lsb in range(1, 9):
-                            decoded_content = png_decode(encoded_file, lsb)
-                            decoded_messages[lsb] = decoded_content
+                        # Attempt decoding from 1 to 8 LSBs for PNG in one read of the image
+                        decoded_messages = png_decode_all(encoded_file)
                         # Rank and display the results
                         ranked_messages = rank_decoded_messages(decoded_messages)
                         for bits, message, count in ranked_messages:
@@ -561,11 +538,8 @@ def decode_section():
 
                 elif extension == "wav":
                     try:
-                        # Attempt decoding from 1 to 8 LSBs for WAV
-                        for lsb in range(1, 9):
-                            decoded_content = wav_decode(encoded_file, lsb)
-                            decoded_messages[lsb] = decoded_content
-                            encoded_file = io.BytesIO(encoded_file.getvalue())
+                        # Attempt decoding from 1 to 8 LSBs for WAV in one read of the audio
+                        decoded_messages = wav_decode_all(encoded_file)
                         # Rank and display the results
                         ranked_messages = rank_decoded_messages(decoded_messages)
                         for bits, message, count in ranked_messages:
@@ -576,12 +550,9 @@ def decode_section():
 
                 elif extension == "flac":
                     try:
-                        # Attempt decoding from 1 to 8 LSBs for WAV
-                        for lsb in range(1, 9):
-                            decoded_content = flac_decode(encoded_file, lsb)
-                            decoded_messages[lsb] = decoded_content
-                            encoded_file = io.BytesIO(encoded_file.getvalue())
-                            # Rank and display the results
+                        # Attempt decoding from 1 to 8 LSBs for FLAC in one read of the audio
+                        decoded_messages = flac_decode_all(encoded_file)
+                        # Rank and display the results
                         ranked_messages = rank_decoded_messages(decoded_messages)
                         for bits, message, count in ranked_messages:
                             st.write(f"Decoded using {bits} LSBs (Alphanumeric Count: {count})")
@@ -591,13 +562,10 @@ def decode_section():
 
                 elif extension == "x-matroska":
                     try:
-                        # Attempt decoding from 1 to 8 LSBs for WAV
-                        for lsb in range(1, 9):
-                            mkv_path = create_temp_file(encoded_file, "mkv")
-                            decoded_content = mkv_decode(mkv_path, lsb)
-                            decoded_messages[lsb] = decoded_content
-                            encoded_file = io.BytesIO(encoded_file.getvalue())
-                            # Rank and display the results
+                        # Attempt decoding from 1 to 8 LSBs for MKV in one decode of the video
+                        mkv_path = create_temp_file(encoded_file, "mkv")
+                        decoded_messages = mkv_decode_all(mkv_path)
+                        # Rank and display the results
                         ranked_messages = rank_decoded_messages(decoded_messages)
                         for bits, message, count in ranked_messages:
                             st.write(f"Decoded using {bits} LSBs (Alphanumeric Count: {count})")
@@ -638,11 +606,18 @@ def decode_section():
                         st.error(f"Error decoding AVI file: {e}")
 
 
+def payload_text(content):
+    """Text shown for decoded content. Binary payloads are shown one character per byte."""
+    if isinstance(content, bytes):
+        return content.decode('latin-1')
+    return content
+
 def rank_decoded_messages(decoded_messages):
     """Rank decoded messages based on the percentage of alphanumeric characters."""
     rankings = []
     
     for bits, message in decoded_messages.items():
+        message = payload_text(message)
         # Calculate total length and alphanumeric count
         total_length = len(message)
         alphanumeric_count = sum(c.isalnum() for c in message)